@@ -9,17 +9,108 @@ GitHub: https://github.com/prasunroy/air-writing
 
 
 # imports
+import os
 import sys
+import threading
+import time
 import webbrowser
 
-from PyQt5.QtCore import Qt, QSize, QTimer
+from PyQt5.QtCore import Qt, QSize, QThread, QTimer, pyqtSignal
 from PyQt5.QtGui import QIcon, QImage, QPixmap
 from PyQt5.QtWidgets import QApplication, QFrame, QWidget
 from PyQt5.QtWidgets import QGridLayout, QHBoxLayout, QVBoxLayout
 from PyQt5.QtWidgets import QDesktopWidget, QLabel, QPushButton
 
+import instrumentation
 from camera import VideoStream
 from pipeline import Pipeline
+from session import SessionRecorder
+
+
+# reference time for cold-start report
+T_START = time.perf_counter()
+
+
+# InferenceWorker class
+class InferenceWorker(QThread):
+    
+    # finished display image with marker motion state and latest prediction
+    frameReady = pyqtSignal(QImage, str)
+    predictionReady = pyqtSignal(object, object)
+    streamEnded = pyqtSignal()
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, video, pipeline, zero_copy=False, engine='EN'):
+        super().__init__()
+        self.video = video
+        self.pipeline = pipeline
+        self.zero_copy = zero_copy
+        self.engine = engine
+        
+        # frames are dropped while the previous one is not painted yet
+        self._running = False
+        self._painting = threading.Event()
+        self.frames_processed = 0
+        self.frames_dropped = 0
+        
+        return
+    
+    # ~~~~~~~~ process frames continuously ~~~~~~~~
+    def run(self):
+        self._running = True
+        while self._running:
+            frame = self.video.getFrame(flip=None if self.zero_copy else 1)
+            if frame is None:
+                # stop when the camera failed to open or stopped delivering frames
+                if self.video.isEnded():
+                    self.streamEnded.emit()
+                    break
+                if not self._painting.is_set():
+                    self._painting.set()
+                    self.frameReady.emit(QImage(), 'lost')
+                # -- threaded streams already wait for frames, this only throttles failed reads --
+                self.msleep(10)
+                continue
+            
+            # overlays are rendered only on frames that will be painted
+            show = not self._painting.is_set()
+            prediction, predprobas, mask, frame = self.pipeline.run_inference(frame, self.engine, True,
+                                                                              self.video.timestamp, show)
+            self.frames_processed += 1
+            if not prediction is None:
+                self.predictionReady.emit(prediction, predprobas)
+            if not show:
+                self.frames_dropped += 1
+                continue
+            
+            # deep copy of frame as its buffer is reused by the next frame
+            if self.zero_copy:
+                image = QImage(frame, frame.shape[1], frame.shape[0], frame.strides[0], QImage.Format_BGR888).mirrored(True, False)
+            else:
+                image = QImage(frame, frame.shape[1], frame.shape[0], frame.strides[0], QImage.Format_RGB888).copy()
+            self._painting.set()
+            self.frameReady.emit(image, self.pipeline.get_motion_state())
+        
+        return
+    
+    # ~~~~~~~~ accept next frame after painting ~~~~~~~~
+    def frameShown(self):
+        self._painting.clear()
+        
+        return
+    
+    # ~~~~~~~~ set recognition engine ~~~~~~~~
+    def setEngine(self, engine='EN'):
+        self.engine = engine
+        
+        return
+    
+    # ~~~~~~~~ stop processing ~~~~~~~~
+    def stop(self):
+        self._running = False
+        self.wait()
+        
+        return
 
 
 # MainGUI class
@@ -35,8 +126,27 @@ class MainGUI(QWidget):
     
     # ~~~~~~~~ initialize pipeline ~~~~~~~~
     def init_pipeline(self):
-        self.pipeline = Pipeline()
+        self.pipeline = Pipeline(backend='numpy')
+        self.pipeline.set_tracking(True)
+        self.pipeline.set_deferred_recognition(True)
+        self.pipeline.set_async_recognition(True)
+        
+        # glyphs are recognized while writing if AIRWRITING_STREAMING is set
+        if os.environ.get('AIRWRITING_STREAMING'):
+            self.pipeline.set_streaming_recognition(True)
         self.engine = 'EN'
+        self.recorder = None
+        
+        # cold-start report
+        self.t_first_frame = None
+        self.t_first_prediction = None
+        
+        # zero-copy frame path
+        # -- frames stay in BGR order and unflipped in reused buffers --
+        # -- Qt mirrors the image while converting it for display --
+        self.zero_copy = hasattr(QImage, 'Format_BGR888')
+        if self.zero_copy:
+            self.pipeline.set_frame_format('BGR', stroke_flip=1)
         
         return
     
@@ -173,15 +283,22 @@ class MainGUI(QWidget):
         if self.flg_conn:
             self.btn_conn.setStyleSheet(self.btn_conn_style_1)
             self.btn_conn.setText('Disconnect Camera')
-            self.video = VideoStream()
-            self.timer = QTimer()
-            self.timer.timeout.connect(self.update)
-            self.timer.start(50)
+            if self.zero_copy:
+                self.video = VideoStream(threaded=True, color='BGR', reuse_buffers=True)
+            else:
+                self.video = VideoStream(threaded=True)
+            self.startRecording()
+            self.worker = InferenceWorker(self.video, self.pipeline, self.zero_copy, self.engine)
+            self.worker.frameReady.connect(self.update)
+            self.worker.predictionReady.connect(self.showPrediction)
+            self.worker.streamEnded.connect(self.streamEnded)
+            self.worker.start()
         else:
             self.btn_conn.setStyleSheet(self.btn_conn_style_0)
             self.btn_conn.setText('Connect Camera')
+            self.worker.stop()
+            self.stopRecording()
             self.cam_feed.clear()
-            self.timer.stop()
             self.video.clear()
             self.disp_pred.setText('!')
             self.disp_prob.setText('Confidence 0.0%')
@@ -189,29 +306,83 @@ class MainGUI(QWidget):
         
         return
     
+    # ~~~~~~~~ disconnect after camera stream ended ~~~~~~~~
+    def streamEnded(self):
+        # ignore workers of earlier connections
+        if not self.flg_conn or not self.sender() is self.worker:
+            return
+        print('[WARNING] Camera stream ended')
+        self.connect()
+        
+        return
+    
+    # ~~~~~~~~ start session recording ~~~~~~~~
+    def startRecording(self):
+        # marker tips and events are recorded into the directory in AIRWRITING_RECORD
+        directory = os.environ.get('AIRWRITING_RECORD')
+        if not directory:
+            return
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, time.strftime('session-%Y%m%d-%H%M%S.session'))
+        self.recorder = SessionRecorder(path, metadata={'source': 'camera'})
+        self.pipeline.set_recorder(self.recorder)
+        
+        return
+    
+    # ~~~~~~~~ stop session recording ~~~~~~~~
+    def stopRecording(self):
+        if not self.recorder is None:
+            self.pipeline.wait_recognition()
+            self.pipeline.set_recorder(None)
+            self.recorder.close()
+            print('[INFO] Session recorded to {}'.format(self.recorder.path))
+            self.recorder = None
+        
+        return
+    
     # ~~~~~~~~ update ~~~~~~~~
-    def update(self):
+    def update(self, frame, motion):
+        # ignore frames queued before disconnecting
+        if not self.flg_conn:
+            return
+        
         # update frame
-        frame = self.video.getFrame(flip=1)
-        if not frame is None:
-            prediction, predprobas, mask, frame = self.pipeline.run_inference(frame, self.engine, True)
-            frame = QImage(frame, frame.shape[1], frame.shape[0], frame.strides[0], QImage.Format_RGB888)
+        if not frame.isNull():
             self.cam_feed.setPixmap(QPixmap.fromImage(frame))
-            if not prediction is None and len(prediction) > 0:
-                self.disp_pred.setText(prediction[0])
-            if not predprobas is None and len(prediction) > 0:
-                self.disp_prob.setText('Confidence {:.1f}%'.format(float(predprobas[0])*100))
+            if self.t_first_frame is None:
+                self.t_first_frame = time.perf_counter() - T_START
+                print('[INFO] Time to first frame: {:.3f}s'.format(self.t_first_frame))
         else:
             self.cam_feed.clear()
         
         # update indicator
-        if self.pipeline._marker_tip is None:
+        if motion == 'lost':
             self.indicator.setStyleSheet('QLabel {background-color: #646464;}')
-        elif self.pipeline._vx < 2.0 and self.pipeline._vy < 2.0:
+        elif motion == 'still':
             self.indicator.setStyleSheet('QLabel {background-color: #f00000;}')
         else:
             self.indicator.setStyleSheet('QLabel {background-color: #00f000;}')
         
+        # accept next frame from worker
+        self.worker.frameShown()
+        
+        return
+    
+    # ~~~~~~~~ show prediction ~~~~~~~~
+    def showPrediction(self, prediction, predprobas):
+        if not self.flg_conn:
+            return
+        if self.t_first_prediction is None:
+            self.t_first_prediction = time.perf_counter() - T_START
+            print('[INFO] Time to first prediction: {:.3f}s'.format(self.t_first_prediction))
+            memory = self.pipeline.get_model_load_memory()
+            for engine, seconds in sorted(self.pipeline.get_model_load_times().items()):
+                print('[INFO] Model {} loaded in {:.3f}s using {:.1f}MB'.format(engine, seconds, memory.get(engine, 0.0)))
+        if len(prediction) > 0:
+            self.disp_pred.setText(prediction[0])
+            self.disp_prob.setText('Confidence {:.1f}%'.format(float(predprobas[0])*100))
+        
         return
     
     # ~~~~~~~~ set recognition engine ~~~~~~~~
@@ -232,6 +403,18 @@ class MainGUI(QWidget):
             self.btn_bn.setStyleSheet(self.btn_engine_style_0)
             self.btn_dv.setStyleSheet(self.btn_engine_style_1)
         
+        if self.flg_conn:
+            self.worker.setEngine(self.engine)
+        
+        # load model in background while the frame loop keeps running
+        self.pipeline.preload_models([self.engine])
+        
+        return
+    
+    # ~~~~~~~~ preload recognition models ~~~~~~~~
+    def preloadModels(self):
+        self.pipeline.preload_models()
+        
         return
     
     # ~~~~~~~~ open repository ~~~~~~~~
@@ -250,10 +433,15 @@ class MainGUI(QWidget):
 
 # main
 if __name__ == '__main__':
+    # stage timing snapshots to a JSONL file or udp://host:port
+    instrumentation.configure(os.environ.get('AIRWRITING_METRICS'))
     app = QApplication(sys.argv)
     app.setStyle('Fusion')
     gui = MainGUI()
     gui.show()
     gui.setFixedSize(gui.size())
     gui.moveWindowToCenter()
-    sys.exit(app.exec_())
+    QTimer.singleShot(0, gui.preloadModels)
+    status = app.exec_()
+    instrumentation.instruments.disable()
+    sys.exit(status)
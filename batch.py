@@ -0,0 +1,376 @@
+# -*- coding: utf-8 -*-
+"""
+Headless batch processing of recorded air-writing sessions.
+Created on Tue May 22 20:00:00 2018
+Author: Prasun Roy | CVPRU-ISICAL (http://www.isical.ac.in/~cvpr)
+GitHub: https://github.com/prasunroy/air-writing
+
+"""
+
+
+# imports
+from __future__ import division
+
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+import cv2
+
+import instrumentation
+from camera import ImageSequence, VideoFile
+from pipeline import Pipeline
+from recognizer import Recognizer
+from session import SessionRecorder
+
+
+# ~~~~~~~~ open recording ~~~~~~~~
+def open_source(path, fps=None):
+    # frames stay in BGR order as decoded
+    if os.path.isdir(path):
+        return ImageSequence(path, fps if not fps is None else 30.0, color='BGR')
+    
+    return VideoFile(path, fps, color='BGR')
+
+
+# ~~~~~~~~ build recognizer from arguments ~~~~~~~~
+def build_recognizer(args, shared_weights=False):
+    # shared weights stay read-only views of the memory-mapped cache, one copy for all workers
+    # -- keras variables are always private copies --
+    recognizer = Recognizer(engines=(args.engine,), backend=args.backend, quantize=args.int8,
+                            shared_weights=shared_weights and args.backend == 'numpy')
+    if args.prediction_cache > 0:
+        recognizer.set_prediction_cache(args.prediction_cache, grid=args.cache_grid,
+                                        levels=args.cache_levels, audit_every=args.cache_audit)
+    
+    return recognizer
+
+
+# ~~~~~~~~ build pipeline from arguments ~~~~~~~~
+def build_pipeline(args, recognizer=None):
+    if recognizer is None:
+        recognizer = build_recognizer(args)
+    pipeline = Pipeline(recognizer=recognizer)
+    pipeline.set_frame_format('BGR', stroke_flip=None if args.flip == 'none' else int(args.flip))
+    pipeline.set_tracking(not args.no_tracking)
+    pipeline.set_quality_tier(args.quality_tier)
+    pipeline.set_detection_scale(args.detection_scale)
+    if args.predictive > 0:
+        pipeline.set_predictive_tracking(True, detect_every=args.predictive)
+    pipeline._vector_glyphs = args.vector_glyphs
+    if args.streaming:
+        pipeline.set_streaming_recognition(True)
+    
+    # thresholds
+    if not args.min_veloxy is None:
+        pipeline._min_veloxy = args.min_veloxy
+    if not args.min_change is None:
+        pipeline._min_change = args.min_change
+    if not args.max_points is None:
+        pipeline._max_points = args.max_points
+    
+    return pipeline
+
+
+# ~~~~~~~~ process recording ~~~~~~~~
+def process(path, pipeline, args, output, start=0, end=None, warmup=0):
+    source = open_source(path, args.fps)
+    render = not args.render_dir is None
+    writer = None
+    
+    # frames before start only warm up stroke and track state
+    # -- records are owned by the segment containing the frame they are emitted at --
+    # -- segment is in sync with sequential run once pipeline was idle during warm-up --
+    first = max(0, start - warmup)
+    if first > 0:
+        source.seek(first)
+    synced = first == 0
+    
+    # marker tips and events of every processed frame including warm-up
+    recorder = None
+    if not args.record_dir is None:
+        name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+        name += '.session' if start == 0 else '-{:08d}.session'.format(start)
+        recorder = SessionRecorder(os.path.join(args.record_dir, name), metadata={'source': path, 'first_frame': first})
+        pipeline.set_recorder(recorder)
+    
+    frames = 0
+    warmup_frames = 0
+    strokes = 0
+    totals = {}
+    t_start = time.perf_counter()
+    while end is None or source.sequence + 1 < end:
+        frame = source.getFrame()
+        if frame is None:
+            break
+        owned = source.sequence >= start
+        
+        prediction, predprobas, mask, frame = pipeline.run_inference(frame, args.engine, not args.no_mapping,
+                                                                     source.timestamp, render and owned)
+        if not owned:
+            warmup_frames += 1
+            synced = synced or pipeline.is_idle()
+            continue
+        frames += 1
+        timings = pipeline.get_stage_timings()
+        for stage, seconds in timings.items():
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        
+        # write rendered frame
+        if render:
+            if writer is None:
+                name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0]
+                name += '.avi' if start == 0 else '-{:08d}.avi'.format(start)
+                writer = cv2.VideoWriter(os.path.join(args.render_dir, name), cv2.VideoWriter_fourcc(*'MJPG'),
+                                         source.fps, (frame.shape[1], frame.shape[0]))
+            writer.write(frame)
+        
+        # write record for every recognized stroke
+        if not prediction is None or args.all_frames:
+            if not prediction is None:
+                strokes += 1
+            record = {
+                'source': path,
+                'frame': source.sequence,
+                'timestamp': round(source.timestamp, 6),
+                'prediction': None if prediction is None else [str(p) for p in prediction],
+                'confidence': None if predprobas is None else [round(float(p), 4) for p in predprobas],
+                'timings_ms': {stage: round(seconds * 1000.0, 3) for stage, seconds in timings.items()}
+            }
+            output.write(json.dumps(record, ensure_ascii=False) + '\n')
+    t_total = time.perf_counter() - t_start
+    
+    # write summary of recording
+    summary = {
+        'source': path,
+        'summary': True,
+        'frames': frames,
+        'strokes': strokes,
+        'seconds': round(t_total, 3),
+        'fps': round((frames + warmup_frames) / t_total, 2) if t_total > 0 else 0.0,
+        'mean_timings_ms': {stage: round(seconds * 1000.0 / frames, 3) for stage, seconds in totals.items()}
+    }
+    if start > 0 or not end is None:
+        summary['segment'] = [start, source.sequence + 1 if end is None else min(end, source.sequence + 1)]
+        summary['warmup_frames'] = warmup_frames
+        summary['synced'] = synced
+    if pipeline._recognizer._cache_size > 0:
+        # -- counted since the recognizer was created, over every recording it served --
+        summary['prediction_cache'] = pipeline._recognizer.get_cache_stats()
+    output.write(json.dumps(summary) + '\n')
+    output.flush()
+    
+    source.clear()
+    if not writer is None:
+        writer.release()
+    if not recorder is None:
+        pipeline.set_recorder(None)
+        recorder.close()
+    
+    return summary
+
+
+# ~~~~~~~~ split recordings into tasks ~~~~~~~~
+def plan_tasks(args):
+    tasks = []
+    for path in args.inputs:
+        source = open_source(path, args.fps)
+        n_frames = source.getFrameCount()
+        length = int(round(args.segment * source.fps))
+        warmup = int(round(args.overlap * source.fps))
+        source.clear()
+        if length <= 0 or n_frames <= length:
+            tasks.append([len(tasks), path, 0, None, 0])
+            continue
+        # last segment runs to end of recording as frame counts may be inexact
+        for start in range(0, n_frames, length):
+            end = start + length if start + length < n_frames else None
+            tasks.append([len(tasks), path, start, end, warmup])
+            if end is None:
+                break
+    
+    return tasks
+
+
+# worker process state
+_worker_args = None
+_worker_recognizer = None
+
+
+# ~~~~~~~~ initialize worker process ~~~~~~~~
+def _init_worker(args):
+    global _worker_args, _worker_recognizer
+    
+    # one thread per process as parallelism comes from the pool
+    cv2.setNumThreads(1)
+    _worker_args = args
+    _worker_recognizer = build_recognizer(args, shared_weights=True)
+    instrumentation.configure(args.metrics, args.metrics_interval)
+    
+    return
+
+
+# ~~~~~~~~ run task in worker process ~~~~~~~~
+def _run_task(task):
+    index, path, start, end, warmup = task
+    part = os.path.join(_worker_args.parts_dir, 'task-{:06d}.jsonl'.format(index))
+    
+    # every task starts with a fresh pipeline sharing the worker's models
+    pipeline = build_pipeline(_worker_args, _worker_recognizer)
+    with io.open(part, 'w', encoding='utf-8') as output:
+        summary = process(path, pipeline, _worker_args, output, start, end, warmup)
+        output.flush()
+        os.fsync(output.fileno())
+    
+    # snapshot per task as pool workers exit without flushing
+    instrumentation.instruments.flush()
+    
+    # done marker is written only after part is complete
+    with open(part[:-len('.jsonl')] + '.done', 'w') as f:
+        f.write('done\n')
+    
+    return index, summary
+
+
+# ~~~~~~~~ process tasks on pool of workers with resume ~~~~~~~~
+def run_parallel(args):
+    import multiprocessing
+    import shutil
+    
+    tasks = plan_tasks(args)
+    args.parts_dir = args.output + '.parts'
+    
+    # parts are reused only if they were produced for the same tasks and options
+    manifest = {'tasks': tasks, 'options': {k: v for k, v in sorted(vars(args).items())
+                                            if not k in ('workers', 'output', 'parts_dir', 'metrics', 'metrics_interval')}}
+    manifest_path = os.path.join(args.parts_dir, 'manifest.json')
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            if json.load(f) != json.loads(json.dumps(manifest)):
+                sys.stderr.write('[WARNING] Discarding partial output of different run\n')
+                shutil.rmtree(args.parts_dir)
+    if not os.path.isdir(args.parts_dir):
+        os.makedirs(args.parts_dir)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+    
+    pending = [task for task in tasks if not os.path.isfile(
+        os.path.join(args.parts_dir, 'task-{:06d}.done'.format(task[0])))]
+    if len(pending) < len(tasks):
+        sys.stderr.write('[INFO] Resuming with {} of {} tasks done\n'.format(len(tasks) - len(pending), len(tasks)))
+    
+    # convert weights once so that workers map the same cache
+    build_recognizer(args, shared_weights=True)
+    
+    if len(pending) > 0:
+        # spawned workers do not inherit threads of this process
+        context = multiprocessing.get_context('spawn')
+        for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            os.environ.setdefault(name, '1')
+        pool = context.Pool(min(args.workers, len(pending)), _init_worker, (args,))
+        try:
+            for index, summary in pool.imap_unordered(_run_task, pending):
+                sys.stderr.write('[INFO] Task {}: {} frames of {}, {} strokes, {:.1f} fps\n'.format(
+                    index, summary['frames'], summary['source'], summary['strokes'], summary['fps']))
+        finally:
+            pool.close()
+            pool.join()
+    
+    # merge parts in task order
+    with io.open(args.output, 'w', encoding='utf-8') as output:
+        for task in tasks:
+            with io.open(os.path.join(args.parts_dir, 'task-{:06d}.jsonl'.format(task[0])), encoding='utf-8') as part:
+                shutil.copyfileobj(part, output)
+    shutil.rmtree(args.parts_dir)
+    
+    return
+
+
+# ~~~~~~~~ command line arguments ~~~~~~~~
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Run air-writing recognition over recorded videos and image directories.')
+    parser.add_argument('inputs', nargs='+', help='video files or directories of images')
+    parser.add_argument('-o', '--output', default='-', help='JSONL output file (default stdout)')
+    parser.add_argument('--engine', default='EN', choices=['EN', 'BN', 'DV'], help='recognition engine')
+    parser.add_argument('--no-mapping', action='store_true', help='write class labels instead of characters')
+    parser.add_argument('--fps', type=float, default=None, help='frame rate for timestamps (default from video or 30)')
+    parser.add_argument('--flip', default='1', choices=['none', '0', '1', '-1'],
+                        help='flip applied to strokes before recognition (default 1 for mirrored camera)')
+    parser.add_argument('--backend', default='numpy', choices=['keras', 'numpy'], help='inference backend')
+    parser.add_argument('--int8', action='store_true', help='use int8 quantized weights')
+    parser.add_argument('--no-tracking', action='store_true', help='search full frame in every frame')
+    parser.add_argument('--predictive', type=int, default=0, metavar='N',
+                        help='kalman tracking with full detection every N-th frame')
+    parser.add_argument('--quality-tier', default='reference', choices=['reference', 'high', 'low'])
+    parser.add_argument('--detection-scale', type=float, default=1.0)
+    parser.add_argument('--vector-glyphs', action='store_true', help='rasterize glyphs from trajectory points')
+    parser.add_argument('--streaming', action='store_true', help='recognize glyphs at pen lifts while writing')
+    parser.add_argument('--prediction-cache', type=int, default=0, metavar='SIZE',
+                        help='cache predictions of up to SIZE normalized glyphs (default 0 disables)')
+    parser.add_argument('--cache-grid', type=int, default=56,
+                        help='downsample glyphs to this grid for cache keys, coarser hits near-duplicates')
+    parser.add_argument('--cache-levels', type=int, default=256,
+                        help='quantize glyphs to this many levels for cache keys, fewer hits near-duplicates')
+    parser.add_argument('--cache-audit', type=int, default=0, metavar='N',
+                        help='verify every N-th cache hit with the model and count mismatches')
+    parser.add_argument('--min-veloxy', type=float, default=None, help='stroke end velocity in pixels per second')
+    parser.add_argument('--min-change', type=int, default=None, help='minimum displacement of trajectory points')
+    parser.add_argument('--max-points', type=int, default=None, help='maximum number of trajectory points')
+    parser.add_argument('--all-frames', action='store_true', help='write a record for every frame')
+    parser.add_argument('--render-dir', default=None, help='write rendered videos into this directory')
+    parser.add_argument('--record-dir', default=None,
+                        help='write compact session recordings for replay into this directory')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='process tasks on a pool of worker processes with resume support')
+    parser.add_argument('--segment', type=float, default=0.0, metavar='SECONDS',
+                        help='split recordings into time ranges of this length for workers')
+    parser.add_argument('--overlap', type=float, default=5.0, metavar='SECONDS',
+                        help='warm-up before each time range, longer than the longest stroke')
+    parser.add_argument('--metrics', default=None, metavar='SPEC',
+                        help='append stage timing snapshots to a JSONL file or send them to udp://host:port')
+    parser.add_argument('--metrics-interval', type=float, default=5.0, metavar='SECONDS',
+                        help='interval between metric snapshots')
+    args = parser.parse_args(argv)
+    
+    # a stroke needs at least two trajectory points to be drawn
+    if not args.max_points is None and args.max_points < 2:
+        parser.error('--max-points must be at least 2')
+    
+    return args
+
+
+# main
+if __name__ == '__main__':
+    args = parse_args()
+    if not args.render_dir is None and not os.path.isdir(args.render_dir):
+        os.makedirs(args.render_dir)
+    if not args.record_dir is None and not os.path.isdir(args.record_dir):
+        os.makedirs(args.record_dir)
+    
+    if args.workers > 0:
+        if args.output == '-':
+            sys.exit('[ERROR] Parallel processing requires an output file')
+        run_parallel(args)
+        sys.exit(0)
+    
+    instrumentation.configure(args.metrics, args.metrics_interval)
+    if args.output == '-':
+        output = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', line_buffering=True)
+    else:
+        output = io.open(args.output, 'w', encoding='utf-8')
+    
+    # models are loaded once and every recording starts with a fresh pipeline
+    recognizer = None
+    for path in args.inputs:
+        pipeline = build_pipeline(args, recognizer)
+        recognizer = pipeline._recognizer
+        summary = process(path, pipeline, args, output)
+        sys.stderr.write('[INFO] {}: {} frames, {} strokes, {:.1f} fps\n'.format(
+            path, summary['frames'], summary['strokes'], summary['fps']))
+    
+    if args.output != '-':
+        output.close()
+    instrumentation.instruments.disable()
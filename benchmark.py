@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark on synthetic marker videos.
+Created on Thu May 24 20:00:00 2018
+Author: Prasun Roy | CVPRU-ISICAL (http://www.isical.ac.in/~cvpr)
+GitHub: https://github.com/prasunroy/air-writing
+
+"""
+
+
+# imports
+from __future__ import division
+
+import argparse
+import io
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import cv2
+import numpy
+
+from instrumentation import Instrumentation
+from pipeline import Pipeline
+from recognizer import Recognizer
+
+
+# digit paths as polylines in unit box
+DIGITS = {
+    0: [(0.50, 0.00), (0.15, 0.20), (0.10, 0.60), (0.30, 1.00), (0.70, 1.00), (0.90, 0.60), (0.85, 0.20), (0.50, 0.00)],
+    1: [(0.30, 0.20), (0.55, 0.00), (0.55, 1.00)],
+    2: [(0.10, 0.20), (0.40, 0.00), (0.80, 0.10), (0.80, 0.40), (0.10, 1.00), (0.90, 1.00)],
+    3: [(0.10, 0.10), (0.80, 0.05), (0.40, 0.45), (0.85, 0.65), (0.60, 1.00), (0.10, 0.90)],
+    4: [(0.60, 0.00), (0.10, 0.65), (0.90, 0.65), (0.65, 0.45), (0.65, 1.00)],
+    5: [(0.85, 0.00), (0.20, 0.00), (0.15, 0.45), (0.70, 0.45), (0.85, 0.75), (0.50, 1.00), (0.10, 0.90)],
+    6: [(0.80, 0.00), (0.30, 0.30), (0.15, 0.75), (0.50, 1.00), (0.85, 0.75), (0.50, 0.50), (0.20, 0.65)],
+    7: [(0.10, 0.00), (0.90, 0.00), (0.40, 1.00)],
+    8: [(0.50, 0.50), (0.15, 0.20), (0.50, 0.00), (0.85, 0.20), (0.50, 0.50), (0.15, 0.80), (0.50, 1.00),
+        (0.85, 0.80), (0.50, 0.50)],
+    9: [(0.85, 0.30), (0.50, 0.00), (0.15, 0.25), (0.50, 0.50), (0.85, 0.30), (0.80, 1.00)]
+}
+
+
+# ~~~~~~~~ points along digit path ~~~~~~~~
+def digit_path(digit, box, step, jitter=0.0, rs=None):
+    x0, y0, w, h = box
+    vertices = numpy.array(DIGITS[digit], dtype='float64') * (w, h) + (x0, y0)
+    
+    # stroke starts with a short lead-in as the first detected position is not a trajectory point
+    # -- first segment is covered in one step as a stroke starts above the velocity threshold --
+    # -- every vertex is kept so the traced glyph matches the polyline --
+    direction = vertices[1] - vertices[0]
+    points = [vertices[0] - direction * 12.0 / numpy.abs(direction).max(), vertices[0]]
+    for i, (a, b) in enumerate(zip(vertices[:-1], vertices[1:])):
+        n = 1 if i == 0 else max(1, int(numpy.hypot(*(b - a)) / step))
+        for t in numpy.arange(1, n + 1) / n:
+            points.append(a + (b - a) * t)
+    points = numpy.array(points)
+    if jitter > 0 and not rs is None:
+        points[2:-1] += rs.randn(len(points) - 3, 2) * jitter
+    
+    return [(int(round(x)), int(round(y))) for x, y in points]
+
+
+# SyntheticVideo class
+class SyntheticVideo(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, size=(640, 480), digits=range(10), fps=30.0, seed=0, clutter=True, noise=4):
+        # frames are generated on demand and identical for identical arguments
+        # -- frames are in BGR order and not mirrored --
+        self.size = size
+        self.digits = list(digits)
+        self.fps = fps
+        self.frame = None
+        self.timestamp = None
+        self.sequence = -1
+        
+        rs = numpy.random.RandomState(seed)
+        w, h = size
+        
+        # marker in the middle of the segmentation hue range
+        self._marker_color = tuple(int(c) for c in
+                                   cv2.cvtColor(numpy.uint8([[[100, 200, 220]]]), cv2.COLOR_HSV2BGR)[0, 0])
+        # -- marker stays wider than half the median blur kernel of segmentation --
+        self._marker_radius = max(9, h // 50)
+        self._marker_length = h // 6
+        
+        # cluttered background of shapes in hues outside the marker range
+        # -- sensor noise cycles through a few precomputed backgrounds --
+        background = self._clutter(rs, w, h) if clutter else numpy.full((h, w, 3), 40, dtype='uint8')
+        self._backgrounds = [background]
+        if noise > 0:
+            self._backgrounds = [numpy.clip(background + rs.randint(-noise, noise + 1, (h, w, 3)), 0, 255).astype('uint8')
+                                 for _ in range(4)]
+        
+        # distractor moving across the frame in a non-marker hue
+        self._distractor_color = tuple(int(c) for c in
+                                       cv2.cvtColor(numpy.uint8([[[20, 220, 230]]]), cv2.COLOR_HSV2BGR)[0, 0])
+        self._distractor_speed = max(2, w // 200)
+        
+        # plan of marker position and digit index per frame
+        # -- each digit is traced, held still until recognized, then the marker leaves --
+        box_h = int(0.8 * h)
+        box_w = max(180, int(0.6 * box_h))
+        box = ((w - box_w) // 2, (h - box_h) // 2, box_w, box_h)
+        self._plan = []
+        for index, digit in enumerate(self.digits):
+            path = digit_path(digit, box, 1.0, 0.0)
+            length = sum(numpy.hypot(b[0] - a[0], b[1] - a[1]) for a, b in zip(path[:-1], path[1:]))
+            step = max(14.0, h / 20.0, length / 40.0)
+            path = digit_path(digit, box, step, step / 10.0, rs)
+            self._plan += [(None, -1)] * 5
+            self._plan += [(point, index) for point in path]
+            self._plan += [(path[-1], index)] * int(fps * 1.4)
+        self._plan += [(None, -1)] * 5
+        
+        return
+    
+    # ~~~~~~~~ cluttered background ~~~~~~~~
+    def _clutter(self, rs, w, h):
+        image = numpy.zeros((h, w, 3), dtype='uint8')
+        image[:] = rs.randint(20, 80, 3)
+        for _ in range(40):
+            # hues below and above the marker range
+            hue = rs.randint(0, 60) if rs.rand() < 0.5 else rs.randint(140, 180)
+            color = tuple(int(c) for c in cv2.cvtColor(numpy.uint8([[[hue, rs.randint(40, 256), rs.randint(40, 256)]]]),
+                                                      cv2.COLOR_HSV2BGR)[0, 0])
+            x, y = rs.randint(0, w), rs.randint(0, h)
+            s = rs.randint(h // 40 + 1, h // 6 + 2)
+            if rs.rand() < 0.5:
+                cv2.rectangle(image, (x, y), (x + s, y + s // 2), color, -1)
+            else:
+                cv2.circle(image, (x, y), s // 2, color, -1)
+        
+        # grey lines and text-like strokes have no saturation to pass the mask
+        for _ in range(20):
+            p0 = (rs.randint(0, w), rs.randint(0, h))
+            p1 = (rs.randint(0, w), rs.randint(0, h))
+            grey = int(rs.randint(0, 256))
+            cv2.line(image, p0, p1, (grey, grey, grey), int(rs.randint(1, 4)))
+        
+        return image
+    
+    # ~~~~~~~~ get number of frames ~~~~~~~~
+    def getFrameCount(self):
+        return len(self._plan)
+    
+    # ~~~~~~~~ digit index traced in frame ~~~~~~~~
+    def getLabel(self, index):
+        return self._plan[index][1]
+    
+    # ~~~~~~~~ seek to frame index ~~~~~~~~
+    def seek(self, index):
+        self.sequence = index - 1
+        
+        return
+    
+    # ~~~~~~~~ render frame ~~~~~~~~
+    def _render(self, index):
+        frame = self._backgrounds[index % len(self._backgrounds)].copy()
+        h, w = frame.shape[:2]
+        
+        # distractor bouncing horizontally
+        span = max(1, w - 2 * self._marker_length)
+        x = self._distractor_speed * index % (2 * span)
+        x = self._marker_length + (x if x < span else 2 * span - x)
+        cv2.circle(frame, (x, h - self._marker_length), self._marker_length // 2, self._distractor_color, -1)
+        
+        # marker with its tip at the top of a pen body
+        point = self._plan[index][0]
+        if not point is None:
+            r = self._marker_radius
+            cv2.rectangle(frame, (point[0] - r, point[1]), (point[0] + r, point[1] + self._marker_length),
+                          self._marker_color, -1)
+            cv2.circle(frame, point, r + 1, self._marker_color, -1)
+        
+        return frame
+    
+    # ~~~~~~~~ get next frame ~~~~~~~~
+    def getFrame(self, flip=None):
+        self.frame = None
+        if self.sequence + 1 < len(self._plan):
+            self.sequence += 1
+            self.timestamp = self.sequence / self.fps
+            self.frame = self._render(self.sequence)
+            if type(flip) is int:
+                self.frame = cv2.flip(self.frame, flip)
+        
+        return self.frame
+    
+    # ~~~~~~~~ clean up and release resources ~~~~~~~~
+    def clear(self):
+        return
+
+
+# ~~~~~~~~ benchmark pipeline on synthetic video ~~~~~~~~
+def bench_pipeline(video, recognizer, args, memory=True):
+    pipeline = Pipeline(recognizer=recognizer)
+    pipeline.set_frame_format('BGR', stroke_flip=None)
+    pipeline.set_tracking(not args.no_tracking)
+    if args.predictive > 0:
+        pipeline.set_predictive_tracking(True, detect_every=args.predictive)
+    
+    # private instrumentation keeps stage timings of this run only
+    instruments = Instrumentation(window=video.getFrameCount())
+    instruments.enable()
+    pipeline.set_instrumentation(instruments)
+    
+    # first prediction of each digit is scored
+    predictions = {}
+    t_total = 0.0
+    peak = 0
+    if memory:
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+    video.seek(0)
+    while True:
+        frame = video.getFrame()
+        if frame is None:
+            break
+        if memory:
+            tracemalloc.reset_peak()
+        t_start = time.perf_counter()
+        prediction, predprobas, mask, frame = pipeline.run_inference(frame, args.engine, True, video.timestamp,
+                                                                     not args.no_render)
+        t_total += time.perf_counter() - t_start
+        if memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        if not prediction is None:
+            instruments.count('predictions')
+            label = video.getLabel(video.sequence)
+            if label >= 0 and not label in predictions:
+                predictions[label] = ''.join(str(p) for p in prediction)
+    if memory:
+        tracemalloc.stop()
+    
+    snapshot = instruments.snapshot()
+    frames = video.getFrameCount()
+    correct = sum(1 for index, digit in enumerate(video.digits) if predictions.get(index) == str(digit))
+    result = {
+        'frames': frames,
+        'fps': round(frames / t_total, 2) if t_total > 0 else 0.0,
+        'accuracy': round(correct / len(video.digits), 4),
+        'strokes': snapshot['counters'].get('strokes', 0),
+        'stages_ms': {stage: {k: v for k, v in summary.items() if k in ('mean', 'p50', 'p90', 'p99', 'max')}
+                      for stage, summary in snapshot['timings_ms'].items()
+                      if stage in ('segmentation', 'identification', 'detection', 'trajectory', 'recognition',
+                                   'render', 'frame')}
+    }
+    if memory:
+        result['peak_traced_mb'] = round((peak - base) / 1048576.0, 3)
+    
+    return result
+
+
+# ~~~~~~~~ benchmark recognizer on glyph images ~~~~~~~~
+def bench_recognizer(recognizer, args, memory=True):
+    rs = numpy.random.RandomState(args.seed)
+    
+    # glyphs traced as the pipeline draws strokes on its canvas
+    images = []
+    labels = []
+    for _ in range(args.glyphs):
+        digit = int(rs.choice(args.digits))
+        h = int(rs.randint(80, 320))
+        w = int(h * rs.uniform(0.5, 0.9))
+        path = digit_path(digit, (4, 4, w, h), 12.0, 1.5, rs)
+        image = numpy.zeros((h + 9, w + 9), dtype='uint8')
+        cv2.polylines(image, [numpy.int32(path).reshape(-1, 1, 2)], False, (255, 255, 255), 4, cv2.LINE_AA)
+        images.append(image)
+        labels.append(str(digit))
+    
+    recognizer.predict(images[0], args.engine)
+    latencies = numpy.zeros(len(images))
+    correct = 0
+    peak = 0
+    if memory:
+        tracemalloc.start()
+        base = tracemalloc.get_traced_memory()[0]
+    for i, image in enumerate(images):
+        if memory:
+            tracemalloc.reset_peak()
+        t_start = time.perf_counter()
+        prediction, predprobas = recognizer.predict(image, args.engine)
+        latencies[i] = time.perf_counter() - t_start
+        if memory:
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+        correct += int(''.join(str(p) for p in prediction) == labels[i])
+    if memory:
+        tracemalloc.stop()
+    
+    latencies *= 1000.0
+    result = {
+        'glyphs': len(images),
+        'fps': round(len(images) / (latencies.sum() / 1000.0), 2),
+        'accuracy': round(correct / len(images), 4),
+        'stages_ms': {'predict': {
+            'mean': round(float(latencies.mean()), 4),
+            'p50': round(float(numpy.percentile(latencies, 50)), 4),
+            'p90': round(float(numpy.percentile(latencies, 90)), 4),
+            'p99': round(float(numpy.percentile(latencies, 99)), 4),
+            'max': round(float(latencies.max()), 4)
+        }}
+    }
+    if memory:
+        result['peak_traced_mb'] = round((peak - base) / 1048576.0, 3)
+    
+    return result
+
+
+# ~~~~~~~~ compare glyphs rasterized from points and from images ~~~~~~~~
+def check_vector_glyphs(recognizer, args):
+    rs = numpy.random.RandomState(args.seed)
+    diffs = []
+    agreed = 0
+    for _ in range(args.glyphs):
+        digit = int(rs.choice(args.digits))
+        h = int(rs.randint(60, 300))
+        w = int(h * rs.uniform(0.5, 0.9))
+        points = numpy.int32(digit_path(digit, (0, 0, w, h), 12.0, 1.5, rs))
+        points = points - points.min(axis=0) + 8
+        image = numpy.zeros((points[:, 1].max() + 9, points[:, 0].max() + 9), dtype='uint8')
+        cv2.polylines(image, [points.reshape(-1, 1, 2)], False, (255, 255, 255), 4, cv2.LINE_AA)
+        
+        # glyphs split into several contours have no single counterpart
+        raster = recognizer._extract_glyphs(image)
+        if raster.shape[0] != 1:
+            continue
+        raster = raster.copy()
+        vector = recognizer.prepare_points(points)
+        diffs.append(float(numpy.abs(raster - vector).mean()))
+        agreed += int(recognizer._classify(raster, args.engine)[0][0] == recognizer._classify(vector, args.engine)[0][0])
+    
+    result = {
+        'glyphs': len(diffs),
+        'mean_abs_diff': round(float(numpy.mean(diffs)), 4),
+        'max_mean_abs_diff': round(float(numpy.max(diffs)), 4),
+        'label_agreement': round(agreed / len(diffs), 4)
+    }
+    
+    return result
+
+
+# ~~~~~~~~ benchmark streaming recognition on multi-digit strokes ~~~~~~~~
+def bench_streaming(recognizer, args):
+    rs = numpy.random.RandomState(args.seed)
+    pipeline = Pipeline(recognizer=recognizer)
+    pipeline.set_streaming_recognition(True)
+    
+    # numbers of 2 to 4 digits written in one stroke at a random speed
+    # -- glyphs are placed spacing pixels apart and joined by short straight connectors --
+    # -- every glyph keeps the lead-in and fast first segment of its digit path --
+    # -- marker is held still until the stroke completes and then lost for a few frames --
+    correct = 0
+    glyphs = 0
+    errors = []
+    timestamp = 0.0
+    for _ in range(args.numbers):
+        number = ''.join(str(d) for d in rs.choice(args.digits, rs.randint(2, 5)))
+        step = rs.uniform(6.0, 16.0)
+        shape = (280, 40 + len(number) * args.spacing)
+        tips = []
+        for i, digit in enumerate(number):
+            path = digit_path(int(digit), (40 + i * args.spacing, 40, 130, 200), step, step / 10.0, rs)
+            if len(tips) > 0:
+                a = numpy.float64(tips[-1])
+                b = numpy.float64(path[0])
+                for t in numpy.arange(1, args.connector_frames + 1) / (args.connector_frames + 1.0):
+                    tips.append(tuple(int(round(v)) for v in a + (b - a) * t))
+            tips += path
+        tips = [None] * 5 + tips + [tips[-1]] * 45
+        
+        for tip in tips:
+            pipeline.run_tracking(tip, shape, args.engine, True, timestamp)
+            timestamp += 1.0 / 30.0
+        pipeline.wait_recognition()
+        events = pipeline.get_events()
+        text = events[-1]['text'] if len(events) > 0 else ''
+        glyphs += len(number)
+        if text == number:
+            correct += 1
+        else:
+            errors.append('{}->{}'.format(number, text))
+    
+    result = {
+        'numbers': args.numbers,
+        'glyphs': glyphs,
+        'connector_frames': args.connector_frames,
+        'spacing': args.spacing,
+        'accuracy': round(correct / args.numbers, 4),
+        'errors': errors
+    }
+    
+    return result
+
+
+# ~~~~~~~~ peak resident memory of process in megabytes ~~~~~~~~
+def _peak_resident_memory():
+    try:
+        import resource
+    except ImportError:
+        return None
+    # kilobytes on linux and bytes on macos
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    
+    return rss / 1048576.0 if sys.platform == 'darwin' else rss / 1024.0
+
+
+# ~~~~~~~~ run all benchmarks ~~~~~~~~
+def run(args):
+    config = {
+        'resolutions': args.resolutions,
+        'digits': ''.join(str(d) for d in args.digits),
+        'seed': args.seed,
+        'glyphs': args.glyphs,
+        'engine': args.engine,
+        'backend': args.backend,
+        'int8': args.int8,
+        'tracking': not args.no_tracking,
+        'predictive': args.predictive,
+        'streaming': args.streaming,
+        'render': not args.no_render
+    }
+    results = {}
+    
+    t_start = time.perf_counter()
+    recognizer = Recognizer(engines=(args.engine,), backend=args.backend, quantize=args.int8)
+    load_seconds = time.perf_counter() - t_start
+    
+    for resolution in args.resolutions:
+        size = tuple(int(v) for v in resolution.lower().split('x'))
+        video = SyntheticVideo(size, args.digits, seed=args.seed)
+        runs = [bench_pipeline(video, recognizer, args, memory=False) for _ in range(args.repeat)]
+        
+        # best of repeated runs is least disturbed by other load
+        result = max(runs, key=lambda r: r['fps'])
+        if not args.no_memory:
+            result['peak_traced_mb'] = bench_pipeline(video, recognizer, args, memory=True)['peak_traced_mb']
+        results['pipeline_' + resolution] = result
+        sys.stderr.write('[INFO] pipeline {}: {:.1f} fps, accuracy {:.2f}, {} strokes\n'.format(
+            resolution, result['fps'], result['accuracy'], result['strokes']))
+    
+    runs = [bench_recognizer(recognizer, args, memory=False) for _ in range(args.repeat)]
+    result = max(runs, key=lambda r: r['fps'])
+    if not args.no_memory:
+        result['peak_traced_mb'] = bench_recognizer(recognizer, args, memory=True)['peak_traced_mb']
+    results['recognizer'] = result
+    sys.stderr.write('[INFO] recognizer: {:.1f} glyphs per second, accuracy {:.2f}\n'.format(
+        result['fps'], result['accuracy']))
+    
+    result = check_vector_glyphs(recognizer, args)
+    results['vector_glyphs'] = result
+    sys.stderr.write('[INFO] vector glyphs: mean abs diff {:.4f}, max {:.4f}, label agreement {:.3f}\n'.format(
+        result['mean_abs_diff'], result['max_mean_abs_diff'], result['label_agreement']))
+    
+    if args.streaming:
+        result = bench_streaming(recognizer, args)
+        results['streaming'] = result
+        sys.stderr.write('[INFO] streaming: accuracy {:.2f} on {} numbers, misread {}\n'.format(
+            result['accuracy'], result['numbers'], ' '.join(result['errors']) or 'none'))
+    
+    # peak since process start, including model loading
+    peak_rss = _peak_resident_memory()
+    report = {
+        'config': config,
+        'system': {
+            'python': platform.python_version(),
+            'numpy': numpy.__version__,
+            'opencv': cv2.__version__,
+            'machine': platform.machine()
+        },
+        'model_load_seconds': round(load_seconds, 3),
+        'peak_rss_mb': None if peak_rss is None else round(peak_rss, 1),
+        'results': results
+    }
+    
+    return report
+
+
+# ~~~~~~~~ compare report against baseline ~~~~~~~~
+def compare(report, baseline, tolerance=0.2, memory_tolerance=0.25):
+    regressions = []
+    if report['config'] != baseline['config']:
+        sys.stderr.write('[WARNING] Baseline was recorded with a different configuration\n')
+    
+    for name, result in sorted(report['results'].items()):
+        if not name in baseline['results']:
+            continue
+        reference = baseline['results'][name]
+        
+        # flatten metrics of run and stages into comparable pairs
+        pairs = [(metric, result.get(metric), reference.get(metric)) for metric in ('fps', 'accuracy', 'peak_traced_mb')]
+        # -- p99 of a few hundred frames is too noisy to gate on and is only saved --
+        for stage, summary in sorted(result.get('stages_ms', {}).items()):
+            for metric in ('p50', 'p90'):
+                pairs.append(('{}.{}'.format(stage, metric), summary.get(metric),
+                              reference.get('stages_ms', {}).get(stage, {}).get(metric)))
+        
+        for metric, value, expected in pairs:
+            if value is None or expected is None:
+                continue
+            # throughput and accuracy regress when lower, latencies and memory when higher
+            # -- accuracy is deterministic and may not drop at all --
+            # -- small absolute margins absorb timer noise of sub-millisecond stages --
+            if metric == 'accuracy':
+                failed = value < expected - 1e-9
+            elif metric == 'fps':
+                failed = value < expected * (1.0 - tolerance)
+            elif metric == 'peak_traced_mb':
+                failed = value > expected * (1.0 + memory_tolerance) + 0.5
+            else:
+                failed = value > expected * (1.0 + tolerance) + 0.05
+            status = 'REGRESSED' if failed else 'ok'
+            print('{:<26} {:<26} {:>12} {:>12}  {}'.format(name, metric, expected, value, status))
+            if failed:
+                regressions.append((name, metric, expected, value))
+    
+    return regressions
+
+
+# ~~~~~~~~ command line arguments ~~~~~~~~
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pipeline and recognizer on synthetic marker videos.')
+    parser.add_argument('--resolutions', nargs='+', default=['320x240', '640x480', '1280x720'])
+    parser.add_argument('--digits', default='0123456789', help='digits traced in every video')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--glyphs', type=int, default=200, help='number of glyph images for recognizer benchmark')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per benchmark of which the fastest is kept')
+    parser.add_argument('--engine', default='EN', choices=['EN'], help='only latin digit paths are generated')
+    parser.add_argument('--backend', default='numpy', choices=['keras', 'numpy'], help='inference backend')
+    parser.add_argument('--int8', action='store_true', help='use int8 quantized weights')
+    parser.add_argument('--no-tracking', action='store_true', help='search full frame in every frame')
+    parser.add_argument('--predictive', type=int, default=0, metavar='N',
+                        help='kalman tracking with full detection every N-th frame')
+    parser.add_argument('--no-render', action='store_true', help='skip rendering of overlays')
+    parser.add_argument('--no-memory', action='store_true', help='skip traced memory measurement')
+    parser.add_argument('--save', default=None, metavar='FILE', help='save results as baseline')
+    parser.add_argument('--compare', default=None, metavar='FILE', help='compare results against baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='relative slowdown accepted before failing')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='relative memory growth accepted')
+    parser.add_argument('--vector-tolerance', type=float, default=0.05,
+                        help='maximum mean absolute input difference of glyphs rasterized from points')
+    parser.add_argument('--min-accuracy', type=float, default=0.0, help='fail if digits are read less accurately from any video')
+    parser.add_argument('--streaming', action='store_true', help='also read multi-digit numbers with streaming recognition')
+    parser.add_argument('--numbers', type=int, default=40, help='number of multi-digit strokes for streaming benchmark')
+    parser.add_argument('--connector-frames', type=int, default=2, help='frames of the fast move between digits')
+    parser.add_argument('--spacing', type=int, default=180, help='horizontal distance of digits in pixels')
+    args = parser.parse_args(argv)
+    args.digits = [int(d) for d in args.digits]
+    
+    return args
+
+
+# main
+if __name__ == '__main__':
+    args = parse_args()
+    report = run(args)
+    
+    if not args.save is None:
+        with io.open(args.save, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+    failed = sorted(name for name, result in report['results'].items()
+                    if (name.startswith('pipeline_') or name == 'streaming') and result['accuracy'] < args.min_accuracy)
+    if len(failed) > 0:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        sys.exit('[ERROR] Accuracy below {} in {}'.format(args.min_accuracy, ', '.join(failed)))
+    if report['results']['vector_glyphs']['max_mean_abs_diff'] > args.vector_tolerance:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        sys.exit('[ERROR] Glyphs rasterized from points differ by more than {}'.format(args.vector_tolerance))
+    if args.compare is None:
+        print(json.dumps(report, indent=2, sort_keys=True))
+        sys.exit(0)
+    
+    with io.open(args.compare, encoding='utf-8') as f:
+        baseline = json.load(f)
+    regressions = compare(report, baseline, args.tolerance, args.memory_tolerance)
+    if len(regressions) > 0:
+        sys.exit('[ERROR] {} metrics regressed against {}'.format(len(regressions), args.compare))
+    print('[INFO] No regressions against {}'.format(args.compare))
@@ -9,16 +9,62 @@ GitHub: https://github.com/prasunroy/air-writing
 
 
 # imports
+import os
+import threading
+import time
+
 import cv2
+import numpy
+
+from instrumentation import instruments
 
 
 # VideoStream class
 class VideoStream(object):
     
     # ~~~~~~~~ constructor ~~~~~~~~
-    def __init__(self, src=0):
+    def __init__(self, src=0, threaded=False, mode='latest', buffer_size=4, color='RGB', reuse_buffers=False):
         self.video = cv2.VideoCapture(src)
         
+        # frame properties
+        self.frame = None
+        self.timestamp = None
+        self.sequence = -1
+        
+        # output format
+        # -- color 'BGR' skips color conversion entirely --
+        # -- reused buffers are overwritten by the next call to getFrame --
+        self._color = color.upper()
+        self._reuse_buffers = reuse_buffers
+        self._frame_raw = None
+        self._frame_rgb = None
+        self._frame_flp = None
+        
+        # background capture
+        # -- mode 'latest' returns the newest frame and drops the stale ones --
+        # -- mode 'ordered' returns every frame in capture order --
+        self._threaded = threaded
+        self._mode = mode
+        self._buffer_size = max(2, buffer_size)
+        self._buffer = None
+        self._buffer_ts = [0.0] * self._buffer_size
+        self._buffer_sq = [-1] * self._buffer_size
+        self._head = 0
+        self._count = 0
+        self._frames_captured = 0
+        self._frames_dropped = 0
+        self._running = False
+        self._eos = False
+        self._thread = None
+        self._lock = threading.Condition()
+        self._frame_out = None
+        
+        # frame read timings
+        self._instruments = instruments
+        
+        if self._threaded:
+            self.start()
+        
         return
     
     # ~~~~~~~~ set target frame dimension ~~~~~~~~
@@ -30,13 +76,227 @@ class VideoStream(object):
         
         return
     
+    # ~~~~~~~~ start background capture ~~~~~~~~
+    def start(self):
+        if self._running:
+            return
+        self._threaded = True
+        self._running = True
+        self._eos = False
+        self._thread = threading.Thread(target=self._capture, daemon=True)
+        self._thread.start()
+        
+        return
+    
+    # ~~~~~~~~ stop background capture ~~~~~~~~
+    def stop(self):
+        with self._lock:
+            self._running = False
+            self._lock.notify_all()
+        if not self._thread is None:
+            self._thread.join()
+            self._thread = None
+        
+        return
+    
+    # ~~~~~~~~ background capture loop ~~~~~~~~
+    def _capture(self):
+        while self._running:
+            # wait for a free slot in ordered mode
+            with self._lock:
+                while self._mode == 'ordered' and self._count >= self._buffer_size and self._running:
+                    self._lock.wait(0.1)
+                if not self._running:
+                    break
+                slot = (self._head + self._count) % self._buffer_size
+                if self._count >= self._buffer_size:
+                    slot = self._head
+            
+            # read frame directly into preallocated slot
+            if self._buffer is None:
+                ret, frame = self.video.read()
+                if ret:
+                    self._buffer = numpy.empty((self._buffer_size,) + frame.shape, dtype=frame.dtype)
+                    self._buffer[slot] = frame
+            else:
+                dst = self._buffer[slot]
+                ret, frame = self.video.read(dst)
+                if ret and not frame is dst:
+                    numpy.copyto(dst, frame)
+            timestamp = time.monotonic()
+            
+            with self._lock:
+                if not ret:
+                    self._eos = True
+                    self._running = False
+                    self._lock.notify_all()
+                    break
+                self._buffer_ts[slot] = timestamp
+                self._buffer_sq[slot] = self._frames_captured
+                self._frames_captured += 1
+                if self._count >= self._buffer_size:
+                    # overwrite oldest frame in latest mode
+                    self._head = (self._head + 1) % self._buffer_size
+                    self._frames_dropped += 1
+                else:
+                    self._count += 1
+                self._lock.notify_all()
+        
+        return
+    
+    # ~~~~~~~~ take frame from ring buffer ~~~~~~~~
+    def _take(self, timeout=1.0):
+        with self._lock:
+            if self._count == 0 and not self._eos:
+                self._lock.wait_for(lambda: self._count > 0 or self._eos or not self._running, timeout)
+            if self._count == 0:
+                return None
+            if self._mode == 'latest':
+                # drop stale frames and keep the newest one
+                self._frames_dropped += self._count - 1
+                self._head = (self._head + self._count - 1) % self._buffer_size
+                self._count = 1
+            slot = self._head
+            if not self._reuse_buffers:
+                frame = self._buffer[slot].copy()
+            else:
+                if self._frame_out is None:
+                    self._frame_out = numpy.empty_like(self._buffer[slot])
+                numpy.copyto(self._frame_out, self._buffer[slot])
+                frame = self._frame_out
+            self.timestamp = self._buffer_ts[slot]
+            self.sequence = self._buffer_sq[slot]
+            self._head = (self._head + 1) % self._buffer_size
+            self._count -= 1
+            self._lock.notify_all()
+        
+        return frame
+    
+    # ~~~~~~~~ set instrumentation ~~~~~~~~
+    def setInstrumentation(self, instrumentation):
+        self._instruments = instrumentation
+        
+        return
+    
     # ~~~~~~~~ get frame from device ~~~~~~~~
     def getFrame(self, flip=None):
-        self.frame = self.video.read()[1]
+        t_start = self._instruments.tick()
+        if self._threaded:
+            self.frame = self._take()
+        elif self._reuse_buffers:
+            ret, self._frame_raw = self.video.read(self._frame_raw)
+            self.frame = self._frame_raw if ret else None
+            self.timestamp = time.monotonic()
+            if not self.frame is None:
+                self.sequence += 1
+        else:
+            self.frame = self.video.read()[1]
+            self.timestamp = time.monotonic()
+            if not self.frame is None:
+                self.sequence += 1
         if not self.frame is None:
-            self.frame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
+            if self._reuse_buffers:
+                if self._color == 'RGB':
+                    self._frame_rgb = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB, dst=self._frame_rgb)
+                    self.frame = self._frame_rgb
+                if type(flip) is int:
+                    self._frame_flp = cv2.flip(self.frame, flip, dst=self._frame_flp)
+                    self.frame = self._frame_flp
+            else:
+                if self._color == 'RGB':
+                    self.frame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
+                if type(flip) is int:
+                    self.frame = cv2.flip(self.frame, flip)
+        self._instruments.tock('capture', t_start)
+        
+        return self.frame
+    
+    # ~~~~~~~~ get number of frames waiting in ring buffer ~~~~~~~~
+    def getQueueDepth(self):
+        with self._lock:
+            depth = self._count
+        
+        return depth
+    
+    # ~~~~~~~~ get number of dropped frames ~~~~~~~~
+    def getDropCount(self):
+        with self._lock:
+            drops = self._frames_dropped
+        
+        return drops
+    
+    # ~~~~~~~~ check if stream ended or device failed to open ~~~~~~~~
+    def isEnded(self):
+        if self._threaded:
+            with self._lock:
+                ended = self._eos
+        else:
+            ended = not self.video.isOpened()
+        
+        return ended
+    
+    # ~~~~~~~~ clean up and release resources ~~~~~~~~
+    def clear(self):
+        self.stop()
+        self.video.release()
+        
+        return
+
+
+# VideoFile class
+class VideoFile(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, path, fps=None, color='RGB'):
+        self.video = cv2.VideoCapture(path)
+        if not self.video.isOpened():
+            raise IOError('cannot open video: {}'.format(path))
+        
+        # frame properties
+        # -- timestamps are derived from frame index and frame rate --
+        self.frame = None
+        self.timestamp = None
+        self.sequence = -1
+        self.fps = fps if not fps is None else self.video.get(cv2.CAP_PROP_FPS)
+        if not self.fps or self.fps <= 0:
+            self.fps = 30.0
+        self._color = color.upper()
+        self._frame_raw = None
+        self._instruments = instruments
+        
+        return
+    
+    # ~~~~~~~~ get number of frames ~~~~~~~~
+    def getFrameCount(self):
+        return int(self.video.get(cv2.CAP_PROP_FRAME_COUNT))
+    
+    # ~~~~~~~~ seek to frame index ~~~~~~~~
+    def seek(self, index):
+        # -- exact for intra-frame codecs, nearest keyframe for some others --
+        self.video.set(cv2.CAP_PROP_POS_FRAMES, index)
+        self.sequence = index - 1
+        
+        return
+    
+    # ~~~~~~~~ set instrumentation ~~~~~~~~
+    def setInstrumentation(self, instrumentation):
+        self._instruments = instrumentation
+        
+        return
+    
+    # ~~~~~~~~ get next frame from file ~~~~~~~~
+    def getFrame(self, flip=None):
+        t_start = self._instruments.tick()
+        ret, self._frame_raw = self.video.read(self._frame_raw)
+        self.frame = self._frame_raw if ret else None
+        if not self.frame is None:
+            self.sequence += 1
+            self.timestamp = self.sequence / self.fps
+            if self._color == 'RGB':
+                self.frame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
             if type(flip) is int:
                 self.frame = cv2.flip(self.frame, flip)
+        self._instruments.tock('capture', t_start)
         
         return self.frame
     
@@ -45,3 +305,67 @@ class VideoStream(object):
         self.video.release()
         
         return
+
+
+# ImageSequence class
+class ImageSequence(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, path, fps=30.0, color='RGB', extensions=('.bmp', '.jpg', '.jpeg', '.png', '.tif', '.tiff')):
+        if not os.path.isdir(path):
+            raise IOError('cannot open image directory: {}'.format(path))
+        
+        # images in lexicographic order of file names
+        self.files = sorted(os.path.join(path, name) for name in os.listdir(path)
+                            if os.path.splitext(name)[1].lower() in extensions)
+        
+        # frame properties
+        # -- timestamps are derived from frame index and frame rate --
+        self.frame = None
+        self.timestamp = None
+        self.sequence = -1
+        self.fps = fps
+        self._color = color.upper()
+        self._instruments = instruments
+        
+        return
+    
+    # ~~~~~~~~ get number of frames ~~~~~~~~
+    def getFrameCount(self):
+        return len(self.files)
+    
+    # ~~~~~~~~ seek to frame index ~~~~~~~~
+    def seek(self, index):
+        self.sequence = index - 1
+        
+        return
+    
+    # ~~~~~~~~ set instrumentation ~~~~~~~~
+    def setInstrumentation(self, instrumentation):
+        self._instruments = instrumentation
+        
+        return
+    
+    # ~~~~~~~~ get next frame from directory ~~~~~~~~
+    def getFrame(self, flip=None):
+        t_start = self._instruments.tick()
+        self.frame = None
+        while self.frame is None and self.sequence + 1 < len(self.files):
+            self.sequence += 1
+            # unreadable images are skipped but keep their time slot
+            self.frame = cv2.imread(self.files[self.sequence], cv2.IMREAD_COLOR)
+        if not self.frame is None:
+            self.timestamp = self.sequence / self.fps
+            if self._color == 'RGB':
+                self.frame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2RGB)
+            if type(flip) is int:
+                self.frame = cv2.flip(self.frame, flip)
+        self._instruments.tock('capture', t_start)
+        
+        return self.frame
+    
+    # ~~~~~~~~ clean up and release resources ~~~~~~~~
+    def clear(self):
+        self.files = []
+        
+        return
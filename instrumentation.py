@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Stage timers, counters and metric sinks.
+Created on Wed May 23 20:00:00 2018
+Author: Prasun Roy | CVPRU-ISICAL (http://www.isical.ac.in/~cvpr)
+GitHub: https://github.com/prasunroy/air-writing
+
+"""
+
+
+# imports
+from __future__ import division
+
+import io
+import json
+import os
+import socket
+import threading
+import time
+
+import numpy
+
+
+# Histogram class
+class Histogram(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, window=1024):
+        # rolling window of latest samples in a ring buffer
+        self._samples = numpy.zeros(window, dtype='float64')
+        self._head = 0
+        self._size = 0
+        self.count = 0
+        self.total = 0.0
+        
+        return
+    
+    # ~~~~~~~~ add sample ~~~~~~~~
+    def add(self, value):
+        self._samples[self._head] = value
+        self._head = (self._head + 1) % self._samples.shape[0]
+        self._size = min(self._size + 1, self._samples.shape[0])
+        self.count += 1
+        self.total += value
+        
+        return
+    
+    # ~~~~~~~~ summary of rolling window ~~~~~~~~
+    def summary(self, percentiles=(50, 90, 99), scale=1.0):
+        if self._size == 0:
+            return {'count': self.count}
+        samples = self._samples[:self._size] * scale
+        summary = {'count': self.count, 'mean': round(float(samples.mean()), 4)}
+        for p, value in zip(percentiles, numpy.percentile(samples, percentiles)):
+            summary['p{}'.format(p)] = round(float(value), 4)
+        summary['max'] = round(float(samples.max()), 4)
+        
+        return summary
+
+
+# FileSink class
+class FileSink(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, path):
+        # snapshots are appended as JSON lines
+        self.path = path
+        self._file = io.open(path, 'a', encoding='utf-8')
+        
+        return
+    
+    # ~~~~~~~~ write snapshot ~~~~~~~~
+    def write(self, snapshot):
+        self._file.write(json.dumps(snapshot) + '\n')
+        self._file.flush()
+        
+        return
+    
+    # ~~~~~~~~ close sink ~~~~~~~~
+    def close(self):
+        self._file.close()
+        
+        return
+
+
+# UdpSink class
+class UdpSink(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, host='127.0.0.1', port=8125):
+        # snapshots are sent as one JSON text datagram each
+        # -- datagrams are dropped silently if nobody listens --
+        self.address = (host, port)
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        
+        return
+    
+    # ~~~~~~~~ write snapshot ~~~~~~~~
+    def write(self, snapshot):
+        try:
+            self._socket.sendto((json.dumps(snapshot) + '\n').encode('utf-8'), self.address)
+        except (IOError, OSError):
+            pass
+        
+        return
+    
+    # ~~~~~~~~ close sink ~~~~~~~~
+    def close(self):
+        self._socket.close()
+        
+        return
+
+
+# Instrumentation class
+class Instrumentation(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, window=1024):
+        # instrumented code checks this flag before reading the clock
+        # -- disabled instrumentation costs one attribute lookup per timer --
+        self.enabled = False
+        
+        # timings in seconds and event counters
+        self._window = window
+        self._timings = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+        self._t_start = time.monotonic()
+        
+        # periodic snapshots
+        self._sink = None
+        self._interval = 5.0
+        self._flusher = None
+        self._stop = threading.Event()
+        
+        return
+    
+    # ~~~~~~~~ start timer ~~~~~~~~
+    def tick(self):
+        return time.perf_counter() if self.enabled else None
+    
+    # ~~~~~~~~ stop timer and record timing ~~~~~~~~
+    def tock(self, name, t_start):
+        if not t_start is None:
+            self.record(name, time.perf_counter() - t_start)
+        
+        return
+    
+    # ~~~~~~~~ record timing in seconds ~~~~~~~~
+    def record(self, name, seconds):
+        with self._lock:
+            histogram = self._timings.get(name)
+            if histogram is None:
+                histogram = self._timings[name] = Histogram(self._window)
+            histogram.add(seconds)
+        
+        return
+    
+    # ~~~~~~~~ increment counter ~~~~~~~~
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+        
+        return
+    
+    # ~~~~~~~~ snapshot of timings and counters ~~~~~~~~
+    def snapshot(self):
+        with self._lock:
+            snapshot = {
+                'time': round(time.time(), 3),
+                'uptime': round(time.monotonic() - self._t_start, 3),
+                'pid': os.getpid(),
+                'timings_ms': {name: histogram.summary(scale=1000.0)
+                               for name, histogram in sorted(self._timings.items())},
+                'counters': dict(sorted(self._counters.items()))
+            }
+        
+        return snapshot
+    
+    # ~~~~~~~~ clear timings and counters ~~~~~~~~
+    def reset(self):
+        with self._lock:
+            self._timings = {}
+            self._counters = {}
+            self._t_start = time.monotonic()
+        
+        return
+    
+    # ~~~~~~~~ enable instrumentation with optional sink ~~~~~~~~
+    def enable(self, sink=None, interval=5.0):
+        self.disable()
+        self._sink = sink
+        self._interval = interval
+        self.enabled = True
+        if not sink is None and interval > 0:
+            self._stop.clear()
+            self._flusher = threading.Thread(target=self._flush_loop, daemon=True)
+            self._flusher.start()
+        
+        return
+    
+    # ~~~~~~~~ disable instrumentation and close sink ~~~~~~~~
+    def disable(self):
+        self.enabled = False
+        if not self._flusher is None:
+            self._stop.set()
+            self._flusher.join()
+            self._flusher = None
+        if not self._sink is None:
+            self.flush()
+            self._sink.close()
+            self._sink = None
+        
+        return
+    
+    # ~~~~~~~~ write snapshot to sink ~~~~~~~~
+    def flush(self):
+        if not self._sink is None:
+            self._sink.write(self.snapshot())
+        
+        return
+    
+    # ~~~~~~~~ write snapshots periodically ~~~~~~~~
+    def _flush_loop(self):
+        while not self._stop.wait(self._interval):
+            self.flush()
+        
+        return
+
+
+# shared instrumentation used unless an object is given its own
+instruments = Instrumentation()
+
+
+# ~~~~~~~~ create sink from specification ~~~~~~~~
+def make_sink(spec):
+    # 'udp://host:port' sends datagrams and any other value names a JSONL file
+    if spec.startswith('udp://'):
+        host, _, port = spec[len('udp://'):].rpartition(':')
+        return UdpSink(host or '127.0.0.1', int(port))
+    
+    return FileSink(spec)
+
+
+# ~~~~~~~~ enable shared instrumentation from specification ~~~~~~~~
+def configure(spec=None, interval=5.0):
+    if spec is None or spec == '':
+        return instruments
+    instruments.enable(make_sink(spec), interval)
+    
+    return instruments
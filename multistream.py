@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-stream pipeline host with cross-stream batching of recognition.
+Created on Wed May 23 20:00:00 2018
+Author: Prasun Roy | CVPRU-ISICAL (http://www.isical.ac.in/~cvpr)
+GitHub: https://github.com/prasunroy/air-writing
+
+"""
+
+
+# imports
+from __future__ import division
+
+import argparse
+import threading
+import time
+
+import numpy
+
+from camera import VideoStream
+from pipeline import Pipeline
+from recognizer import Recognizer
+
+
+# ~~~~~~~~ latency summary in milliseconds ~~~~~~~~
+def _summarize(values):
+    if len(values) == 0:
+        return {'count': 0}
+    values = numpy.asarray(values) * 1000.0
+    
+    return {
+        'count': int(values.size),
+        'mean': round(float(values.mean()), 3),
+        'p50': round(float(numpy.percentile(values, 50)), 3),
+        'p95': round(float(numpy.percentile(values, 95)), 3),
+        'max': round(float(values.max()), 3)
+    }
+
+
+# BatchingRecognizer class
+class BatchingRecognizer(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, recognizer, max_delay=0.01, max_batch=32):
+        # glyphs of all streams are classified by one scheduler thread
+        # -- a batch closes when the oldest request waited max delay or the batch is full --
+        self._recognizer = recognizer
+        self._max_delay = max_delay
+        self._max_batch = max_batch
+        
+        # pending requests
+        self._queue = []
+        self._cond = threading.Condition()
+        self._prepare_lock = threading.Lock()
+        self._running = True
+        
+        # statistics
+        self._latencies = {}
+        self._batch_sizes = []
+        self._batch_glyphs = []
+        
+        self._thread = threading.Thread(target=self._schedule, daemon=True)
+        self._thread.start()
+        
+        return
+    
+    # ~~~~~~~~ recognizer for stream ~~~~~~~~
+    def client(self, stream_id):
+        with self._cond:
+            self._latencies.setdefault(stream_id, [])
+        
+        return _StreamClient(self, stream_id)
+    
+    # ~~~~~~~~ submit features and wait for predictions ~~~~~~~~
+    def _submit(self, stream_id, features, engine, mapping):
+        request = {
+            'stream': stream_id,
+            'features': features,
+            'engine': engine.upper(),
+            'mapping': mapping,
+            'time': time.perf_counter(),
+            'done': threading.Event(),
+            'result': None
+        }
+        with self._cond:
+            self._queue.append(request)
+            self._cond.notify_all()
+        request['done'].wait()
+        
+        return request['result']
+    
+    # ~~~~~~~~ predict from stroke image ~~~~~~~~
+    def predict(self, stream_id, image, engine='EN', mapping=True):
+        # preprocessing buffers of recognizer are shared so features are copied out
+        with self._prepare_lock:
+            features = self._recognizer._extract_glyphs(image).copy()
+        
+        return self._submit(stream_id, features, engine, mapping)
+    
+    # ~~~~~~~~ predict from stroke points ~~~~~~~~
+    def predict_points(self, stream_id, points, engine='EN', mapping=True, thickness=4):
+        with self._prepare_lock:
+            features = self._recognizer.prepare_points(points, thickness).copy()
+        
+        return self._submit(stream_id, features, engine, mapping)
+    
+    # ~~~~~~~~ scheduler loop ~~~~~~~~
+    def _schedule(self):
+        while True:
+            with self._cond:
+                # wait for first request
+                while self._running and len(self._queue) == 0:
+                    self._cond.wait()
+                if not self._running and len(self._queue) == 0:
+                    break
+                
+                # gather requests of all streams until deadline of oldest request
+                deadline = self._queue[0]['time'] + self._max_delay
+                while self._running and len(self._queue) < self._max_batch:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = self._queue[:self._max_batch]
+                self._queue = self._queue[self._max_batch:]
+            
+            self._run_batch(batch)
+        
+        return
+    
+    # ~~~~~~~~ classify gathered requests ~~~~~~~~
+    def _run_batch(self, batch):
+        # one model call per engine and mapping
+        groups = {}
+        for request in batch:
+            groups.setdefault((request['engine'], request['mapping']), []).append(request)
+        n_glyphs = 0
+        for (engine, mapping), requests in groups.items():
+            features = numpy.concatenate([request['features'] for request in requests])
+            n_glyphs += features.shape[0]
+            try:
+                labels, probas = self._recognizer._classify(features, engine, mapping)
+                error = None
+            except Exception as e:
+                error = e
+            offset = 0
+            for request in requests:
+                n = request['features'].shape[0]
+                request['result'] = error if not error is None else [labels[offset:offset+n], probas[offset:offset+n]]
+                offset += n
+        
+        # record statistics before releasing waiting streams
+        t_done = time.perf_counter()
+        with self._cond:
+            self._batch_sizes.append(len(batch))
+            self._batch_glyphs.append(n_glyphs)
+            for request in batch:
+                self._latencies[request['stream']].append(t_done - request['time'])
+        for request in batch:
+            request['done'].set()
+        
+        return
+    
+    # ~~~~~~~~ batching statistics ~~~~~~~~
+    def get_stats(self):
+        with self._cond:
+            sizes = numpy.asarray(self._batch_sizes)
+            glyphs = numpy.asarray(self._batch_glyphs)
+            stats = {
+                'batches': int(sizes.size),
+                'mean_batch_size': round(float(sizes.mean()), 3) if sizes.size > 0 else 0.0,
+                'max_batch_size': int(sizes.max()) if sizes.size > 0 else 0,
+                'mean_batch_glyphs': round(float(glyphs.mean()), 3) if glyphs.size > 0 else 0.0,
+                'batch_size_histogram': {int(k): int(v) for k, v in zip(*numpy.unique(sizes, return_counts=True))},
+                'latency_ms': {stream_id: _summarize(values) for stream_id, values in self._latencies.items()}
+            }
+        
+        return stats
+    
+    # ~~~~~~~~ stop scheduler after pending requests ~~~~~~~~
+    def close(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        self._thread.join()
+        
+        return
+
+
+# _StreamClient class
+class _StreamClient(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, batcher, stream_id):
+        self._batcher = batcher
+        self._stream_id = stream_id
+        
+        return
+    
+    # ~~~~~~~~ predict ~~~~~~~~
+    def predict(self, image, engine='EN', mapping=True):
+        result = self._batcher.predict(self._stream_id, image, engine, mapping)
+        if isinstance(result, Exception):
+            raise result
+        
+        return result
+    
+    # ~~~~~~~~ predict from stroke points ~~~~~~~~
+    def predict_points(self, points, engine='EN', mapping=True, thickness=4):
+        result = self._batcher.predict_points(self._stream_id, points, engine, mapping, thickness)
+        if isinstance(result, Exception):
+            raise result
+        
+        return result
+    
+    # ~~~~~~~~ check if model of engine is loaded ~~~~~~~~
+    def is_ready(self, engine='EN'):
+        return self._batcher._recognizer.is_ready(engine)
+    
+    # ~~~~~~~~ load models shared by all streams ~~~~~~~~
+    def preload(self, engines=None):
+        return self._batcher._recognizer.preload(engines)
+    
+    # ~~~~~~~~ model load times ~~~~~~~~
+    def get_load_times(self):
+        return self._batcher._recognizer.get_load_times()
+    
+    # ~~~~~~~~ resident memory added by model loads ~~~~~~~~
+    def get_load_memory(self):
+        return self._batcher._recognizer.get_load_memory()
+
+
+# MultiStreamHost class
+class MultiStreamHost(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, recognizer=None, max_delay=0.01, max_batch=32, engine='EN', mapping=True):
+        # one recognizer and scheduler shared by every stream
+        if recognizer is None:
+            recognizer = Recognizer(engines=(engine,), backend='numpy', shared_weights=True)
+        self._batcher = BatchingRecognizer(recognizer, max_delay, max_batch)
+        self._engine = engine
+        self._mapping = mapping
+        
+        # streams
+        self._streams = {}
+        self._lock = threading.Lock()
+        self._results = []
+        
+        return
+    
+    # ~~~~~~~~ add stream ~~~~~~~~
+    def add_stream(self, stream_id, source, realtime=False, configure=None):
+        # every stream has its own segmentation, tracking and trajectory state
+        pipeline = Pipeline(recognizer=self._batcher.client(stream_id))
+        pipeline.set_frame_format('BGR', stroke_flip=1)
+        pipeline.set_tracking(True)
+        if not configure is None:
+            configure(pipeline)
+        stream = {
+            'source': source,
+            'pipeline': pipeline,
+            'realtime': realtime,
+            'frames': 0,
+            'strokes': 0,
+            'seconds': 0.0,
+            'thread': None
+        }
+        with self._lock:
+            self._streams[stream_id] = stream
+        
+        return pipeline
+    
+    # ~~~~~~~~ stream loop ~~~~~~~~
+    def _run_stream(self, stream_id, stream):
+        source = stream['source']
+        pipeline = stream['pipeline']
+        t_start = time.perf_counter()
+        t_first = None
+        while True:
+            frame = source.getFrame()
+            if frame is None:
+                break
+            # pace recorded sources at their frame rate to emulate cameras
+            if stream['realtime']:
+                if t_first is None:
+                    t_first = time.perf_counter() - source.timestamp
+                delay = t_first + source.timestamp - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            prediction, predprobas, mask, frame = pipeline.run_inference(frame, self._engine, self._mapping,
+                                                                         source.timestamp, render=False)
+            stream['frames'] += 1
+            if not prediction is None:
+                stream['strokes'] += 1
+                with self._lock:
+                    self._results.append((stream_id, source.sequence, prediction, predprobas))
+        stream['seconds'] = time.perf_counter() - t_start
+        
+        return
+    
+    # ~~~~~~~~ start streams ~~~~~~~~
+    def start(self):
+        with self._lock:
+            for stream_id, stream in self._streams.items():
+                if stream['thread'] is None:
+                    stream['thread'] = threading.Thread(target=self._run_stream, args=(stream_id, stream), daemon=True)
+                    stream['thread'].start()
+        
+        return
+    
+    # ~~~~~~~~ wait for streams to end ~~~~~~~~
+    def join(self, timeout=None):
+        for stream in list(self._streams.values()):
+            if not stream['thread'] is None:
+                stream['thread'].join(timeout)
+        
+        return
+    
+    # ~~~~~~~~ predictions since last call ~~~~~~~~
+    def get_results(self):
+        with self._lock:
+            results = self._results
+            self._results = []
+        
+        return results
+    
+    # ~~~~~~~~ per-stream and batching statistics ~~~~~~~~
+    def get_stats(self):
+        stats = self._batcher.get_stats()
+        stats['streams'] = {}
+        for stream_id, stream in self._streams.items():
+            seconds = stream['seconds'] if stream['seconds'] > 0 else None
+            stats['streams'][stream_id] = {
+                'frames': stream['frames'],
+                'strokes': stream['strokes'],
+                'fps': round(stream['frames'] / seconds, 2) if not seconds is None else None,
+                'latency_ms': stats['latency_ms'].get(stream_id, {'count': 0})
+            }
+        del stats['latency_ms']
+        
+        return stats
+    
+    # ~~~~~~~~ stop scheduler and release sources ~~~~~~~~
+    def close(self):
+        self._batcher.close()
+        for stream in self._streams.values():
+            stream['source'].clear()
+        
+        return
+
+
+# main
+if __name__ == '__main__':
+    import json
+    
+    from batch import open_source
+    
+    parser = argparse.ArgumentParser(description='Run air-writing recognition on several streams with shared batching.')
+    parser.add_argument('sources', nargs='+', help='camera indices, video files or directories of images')
+    parser.add_argument('--engine', default='EN', choices=['EN', 'BN', 'DV'])
+    parser.add_argument('--max-delay', type=float, default=10.0, help='batching deadline in milliseconds')
+    parser.add_argument('--max-batch', type=int, default=32, help='maximum requests per batch')
+    parser.add_argument('--realtime', action='store_true', help='pace recorded sources at their frame rate')
+    args = parser.parse_args()
+    
+    host = MultiStreamHost(max_delay=args.max_delay / 1000.0, max_batch=args.max_batch, engine=args.engine)
+    for i, src in enumerate(args.sources):
+        if src.isdigit():
+            source = VideoStream(int(src), threaded=True, color='BGR')
+        else:
+            source = open_source(src)
+        host.add_stream('{}:{}'.format(i, src), source, args.realtime)
+    host.start()
+    host.join()
+    for stream_id, frame, prediction, predprobas in host.get_results():
+        print('{} frame {}: {} {}'.format(stream_id, frame, list(prediction), list(predprobas)))
+    print(json.dumps(host.get_stats(), indent=2))
+    host.close()
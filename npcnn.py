@@ -0,0 +1,391 @@
+# -*- coding: utf-8 -*-
+"""
+NumPy inference engine for numeral CNN.
+Created on Mon May 21 20:00:00 2018
+Author: Prasun Roy | CVPRU-ISICAL (http://www.isical.ac.in/~cvpr)
+GitHub: https://github.com/prasunroy/air-writing
+
+"""
+
+
+# imports
+from __future__ import division
+
+import argparse
+import glob
+import hashlib
+import os
+import sys
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+
+# flat weight file format
+# -- int32 header: magic, version, quantized, number of layers --
+# -- int32 shape of each layer: kernel height, kernel width, inputs, outputs --
+# -- dense layers have kernel height and width of zero --
+# -- per layer: kernel in im2col layout, bias and, if quantized, column scales --
+# -- float32 kernels or int8 kernels padded to four bytes --
+MAGIC = 0x4e50434e
+VERSION = 1
+
+
+# converted weight cache
+# -- entries are keyed by checksum of source model and rebuilt when it changes --
+# -- AIRWRITING_CACHE moves the cache out of the source tree --
+CACHE_DIR = os.environ.get('AIRWRITING_CACHE') or 'models/cache'
+
+
+# ~~~~~~~~ checksum of file ~~~~~~~~
+def checksum(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    
+    return sha1.hexdigest()
+
+
+# ~~~~~~~~ cache file path for model ~~~~~~~~
+def cache_path(path, suffix='', cache_dir=None):
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    name = os.path.splitext(os.path.basename(path))[0] + suffix
+    
+    return os.path.join(cache_dir, '{}-{}.npy'.format(name, checksum(path)[:16]))
+
+
+# ~~~~~~~~ load flat buffer from cache or build and store it ~~~~~~~~
+def cached(path, suffix, build, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = CACHE_DIR
+    target = cache_path(path, suffix, cache_dir)
+    if os.path.isfile(target):
+        try:
+            return numpy.load(target, mmap_mode='r')
+        except (IOError, OSError, ValueError):
+            pass
+    
+    buffer = build()
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        
+        # drop entries of older versions of model
+        name = os.path.basename(target).rsplit('-', 1)[0]
+        for stale in glob.glob(os.path.join(cache_dir, '{}-*.npy'.format(name))):
+            if os.path.basename(stale) != os.path.basename(target):
+                os.remove(stale)
+        
+        # write to temporary file and rename so that readers never see partial entries
+        temp = '{}.{}.tmp'.format(target, os.getpid())
+        with open(temp, 'wb') as f:
+            numpy.save(f, buffer)
+        os.replace(temp, target)
+        
+        return numpy.load(target, mmap_mode='r')
+    except (IOError, OSError):
+        return buffer
+
+
+# ~~~~~~~~ read layers from keras model ~~~~~~~~
+def read_h5(path):
+    import h5py
+    
+    layers = []
+    with h5py.File(path, 'r') as f:
+        group = f['model_weights'] if 'model_weights' in f else f
+        backend = group.attrs.get('backend', f.attrs.get('backend', b'tensorflow'))
+        backend = backend.decode() if isinstance(backend, bytes) else str(backend)
+        for name in group.attrs['layer_names']:
+            layer = group[name.decode() if isinstance(name, bytes) else name]
+            names = [n.decode() if isinstance(n, bytes) else n for n in layer.attrs['weight_names']]
+            if len(names) == 0:
+                continue
+            kernel = numpy.array(layer[names[0]], dtype='float32')
+            bias = numpy.array(layer[names[1]], dtype='float32')
+            layers.append([kernel, bias])
+    
+    # theano convolves with kernels flipped in both spatial dimensions
+    if backend == 'theano':
+        for layer in layers:
+            if layer[0].ndim == 4:
+                layer[0] = numpy.ascontiguousarray(layer[0][::-1, ::-1])
+    
+    return layers
+
+
+# ~~~~~~~~ pack layers into flat weight buffer ~~~~~~~~
+def pack(layers, quantize=False, i_shape=(1, 56, 56)):
+    header = [MAGIC, VERSION, int(quantize), len(layers)]
+    chunks = []
+    
+    # spatial shape of feature maps in channels-last order
+    h, w, c = i_shape[1], i_shape[2], i_shape[0]
+    conv = True
+    for kernel, bias in layers:
+        if kernel.ndim == 4:
+            # kernel (kh, kw, in, out) matches patches in (kh, kw, in) order
+            kh, kw, n_in, n_out = kernel.shape
+            matrix = kernel.reshape(kh * kw * n_in, n_out)
+            h, w, c = (h - kh + 1) // 2, (w - kw + 1) // 2, n_out
+        else:
+            kh, kw = 0, 0
+            n_in, n_out = kernel.shape
+            matrix = kernel
+            if conv and n_in == h * w * c:
+                # keras flattens channels-first feature maps, this engine channels-last
+                matrix = kernel.reshape(c, h, w, n_out).transpose(1, 2, 0, 3).reshape(n_in, n_out)
+            conv = False
+        header.extend([kh, kw, n_in, n_out])
+        
+        if quantize:
+            # symmetric per column quantization
+            scale = numpy.abs(matrix).max(axis=0) / 127.0
+            scale[scale == 0] = 1.0
+            q = numpy.round(matrix / scale).astype('int8').tobytes()
+            chunks.append(q + b'\x00' * (-len(q) % 4))
+            chunks.append(bias.astype('float32').tobytes())
+            chunks.append(scale.astype('float32').tobytes())
+        else:
+            chunks.append(numpy.ascontiguousarray(matrix, dtype='float32').tobytes())
+            chunks.append(bias.astype('float32').tobytes())
+    
+    data = numpy.array(header, dtype='int32').tobytes() + b''.join(chunks)
+    
+    return numpy.frombuffer(data, dtype='uint8')
+
+
+# ~~~~~~~~ export keras model to flat weight file ~~~~~~~~
+def export(path, quantize=False, output=None, cache_dir=None):
+    if output is None:
+        cached(path, '_int8' if quantize else '', lambda: pack(read_h5(path), quantize), cache_dir)
+        return cache_path(path, '_int8' if quantize else '', cache_dir)
+    numpy.save(output, pack(read_h5(path), quantize))
+    
+    return output
+
+
+# ~~~~~~~~ load numpy model for keras model ~~~~~~~~
+def load(path, quantize=False, cache_dir=None, dequantize=True):
+    # weights are memory-mapped from cache and exported on first use
+    buffer = cached(path, '_int8' if quantize else '', lambda: pack(read_h5(path), quantize), cache_dir)
+    
+    return NumpyCNN(buffer, dequantize=dequantize)
+
+
+# NumpyCNN class
+class NumpyCNN(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, buffer, batch_size=32, dequantize=True):
+        buffer = numpy.asarray(buffer, dtype='uint8')
+        header = buffer[:16].view('int32')
+        if int(header[0]) != MAGIC or int(header[1]) != VERSION:
+            raise ValueError('invalid weight buffer')
+        self.quantized = bool(header[2])
+        n_layers = int(header[3])
+        shapes = buffer[16:16+16*n_layers].view('int32').reshape(n_layers, 4)
+        
+        # unpack layers as views into buffer
+        # -- views of a read-only memory map are shared by every process mapping it --
+        # -- int8 kernels kept as views are dequantized per call instead of at load --
+        self._layers = []
+        offset = 16 + 16 * n_layers
+        for kh, kw, n_in, n_out in shapes.tolist():
+            rows = kh * kw * n_in if kh > 0 else n_in
+            if self.quantized:
+                size = rows * n_out
+                q = buffer[offset:offset+size].view('int8').reshape(rows, n_out)
+                offset += size + (-size % 4)
+                bias = buffer[offset:offset+4*n_out].view('float32')
+                offset += 4 * n_out
+                scale = buffer[offset:offset+4*n_out].view('float32')
+                offset += 4 * n_out
+                # weight-only quantization is dequantized for float32 matmul
+                if dequantize:
+                    kernel = q.astype('float32') * scale
+                    scale = None
+                else:
+                    kernel = q
+            else:
+                kernel = buffer[offset:offset+4*rows*n_out].view('float32').reshape(rows, n_out)
+                offset += 4 * rows * n_out
+                bias = buffer[offset:offset+4*n_out].view('float32')
+                offset += 4 * n_out
+                scale = None
+            self._layers.append(((kh, kw), kernel, bias, scale))
+        
+        self._batch_size = batch_size
+        
+        return
+    
+    # ~~~~~~~~ convolution with im2col and matmul ~~~~~~~~
+    def _conv(self, x, ksize, kernel, bias):
+        n, h, w, c = x.shape
+        kh, kw = ksize
+        oh = h - kh + 1
+        ow = w - kw + 1
+        
+        # patches in (kh, kw, in) order as rows of column matrix
+        s = x.strides
+        cols = as_strided(x, (n, oh, ow, kh, kw, c), (s[0], s[1], s[2], s[1], s[2], s[3]))
+        cols = cols.reshape(n * oh * ow, kh * kw * c)
+        y = numpy.dot(cols, kernel)
+        y += bias
+        numpy.maximum(y, 0, out=y)
+        
+        return y.reshape(n, oh, ow, -1)
+    
+    # ~~~~~~~~ max pooling ~~~~~~~~
+    def _pool(self, x):
+        n, h, w, c = x.shape
+        x = x[:, :h//2*2, :w//2*2]
+        
+        return x.reshape(n, h // 2, 2, w // 2, 2, c).max(axis=(2, 4))
+    
+    # ~~~~~~~~ forward pass ~~~~~~~~
+    def _forward(self, x):
+        # channels-first input to channels-last feature maps
+        x = numpy.ascontiguousarray(x.transpose(0, 2, 3, 1), dtype='float32')
+        
+        n_layers = len(self._layers)
+        for i, (ksize, kernel, bias, scale) in enumerate(self._layers):
+            if not scale is None:
+                kernel = kernel * scale
+            if ksize[0] > 0:
+                x = self._pool(self._conv(x, ksize, kernel, bias))
+            else:
+                x = numpy.dot(x.reshape(x.shape[0], -1), kernel)
+                x += bias
+                if i < n_layers - 1:
+                    numpy.maximum(x, 0, out=x)
+        
+        # softmax
+        x -= x.max(axis=1, keepdims=True)
+        numpy.exp(x, out=x)
+        x /= x.sum(axis=1, keepdims=True)
+        
+        return x
+    
+    # ~~~~~~~~ predict class probabilities ~~~~~~~~
+    def predict(self, x, batch_size=None):
+        x = numpy.asarray(x, dtype='float32')
+        if batch_size is None:
+            batch_size = self._batch_size
+        if x.shape[0] == 0:
+            return numpy.zeros((0, self._layers[-1][1].shape[1]), dtype='float32')
+        outputs = [self._forward(x[i:i+batch_size]) for i in range(0, x.shape[0], batch_size)]
+        
+        return outputs[0] if len(outputs) == 1 else numpy.concatenate(outputs)
+
+
+# ~~~~~~~~ verify numpy model against keras model ~~~~~~~~
+def verify(path, quantize=False, n_samples=64, seed=0):
+    from recognizer import Recognizer
+    
+    # random sparse strokes resemble preprocessed glyphs better than noise
+    rs = numpy.random.RandomState(seed)
+    x = (rs.rand(n_samples, 1, 56, 56) > 0.85).astype('float32')
+    
+    reference = Recognizer(engines=())._cnn((1, 56, 56), 10, path).predict(x)
+    output = load(path, quantize).predict(x)
+    
+    return {
+        'max_abs_diff': float(numpy.abs(reference - output).max()),
+        'label_agreement': float(numpy.mean(reference.argmax(axis=1) == output.argmax(axis=1)))
+    }
+
+
+# ~~~~~~~~ reference forward pass over keras layer weights ~~~~~~~~
+def reference_predict(layers, x):
+    import cv2
+    
+    # channels-first feature maps and flatten order as keras computes them
+    # -- filter2D correlates around the kernel centre, cropping its border gives valid convolution --
+    x = numpy.asarray(x, dtype='float32')
+    outputs = []
+    for sample in x:
+        maps = sample
+        for i, (kernel, bias) in enumerate(layers):
+            if kernel.ndim == 4:
+                kh, kw, n_in, n_out = kernel.shape
+                h, w = maps.shape[1] - kh + 1, maps.shape[2] - kw + 1
+                y = numpy.empty((n_out, h, w), dtype='float32')
+                for o in range(n_out):
+                    total = numpy.full((h, w), bias[o], dtype='float32')
+                    for c in range(n_in):
+                        full = cv2.filter2D(maps[c], cv2.CV_32F, kernel[:, :, c, o])
+                        total += full[kh//2:kh//2+h, kw//2:kw//2+w]
+                    y[o] = numpy.maximum(total, 0)
+                maps = y[:, :h//2*2, :w//2*2].reshape(n_out, h // 2, 2, w // 2, 2).max(axis=(2, 4))
+            else:
+                maps = numpy.dot(maps.reshape(-1), kernel) + bias
+                if i < len(layers) - 1:
+                    maps = numpy.maximum(maps, 0)
+        maps = numpy.exp(maps - maps.max())
+        outputs.append(maps / maps.sum())
+    
+    return numpy.array(outputs)
+
+
+# ~~~~~~~~ check numpy model against reference forward pass ~~~~~~~~
+def check(path, n_samples=64, seed=0):
+    # keras is not needed and float32 and int8 weights are compared on the same inputs
+    rs = numpy.random.RandomState(seed)
+    x = (rs.rand(n_samples, 1, 56, 56) > 0.85).astype('float32')
+    
+    # weights are packed afresh as cache entries are not rebuilt when only this module changes
+    layers = read_h5(path)
+    reference = reference_predict(layers, x)
+    output = NumpyCNN(pack(layers)).predict(x)
+    output_int8 = NumpyCNN(pack(layers, quantize=True)).predict(x)
+    
+    return {
+        'max_abs_diff': float(numpy.abs(reference - output).max()),
+        'label_agreement': float(numpy.mean(reference.argmax(axis=1) == output.argmax(axis=1))),
+        'int8_max_abs_diff': float(numpy.abs(output - output_int8).max()),
+        'int8_label_agreement': float(numpy.mean(output.argmax(axis=1) == output_int8.argmax(axis=1)))
+    }
+
+
+# main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export numeral CNN weights for NumPy inference.')
+    parser.add_argument('models', nargs='*', default=['models/en_numbers_ft.h5',
+                                                      'models/bn_numbers_ft.h5',
+                                                      'models/dv_numbers_ft.h5'])
+    parser.add_argument('--int8', action='store_true', help='export int8 quantized weights')
+    parser.add_argument('--cache-dir', default=None, help='converted weight cache (default {})'.format(CACHE_DIR))
+    parser.add_argument('--verify', action='store_true', help='compare outputs with keras')
+    parser.add_argument('--check', action='store_true',
+                        help='compare float32 and int8 outputs with a reference forward pass without keras')
+    parser.add_argument('--tolerance', type=float, default=None,
+                        help='maximum absolute probability difference (default 1e-4, int8 5e-2)')
+    args = parser.parse_args()
+    
+    tolerance = args.tolerance
+    if tolerance is None:
+        tolerance = 5e-2 if args.int8 else 1e-4
+    
+    failed = False
+    for path in args.models:
+        output = export(path, args.int8, cache_dir=args.cache_dir)
+        print('[INFO] Exported {} to {}'.format(path, output))
+        if args.verify:
+            result = verify(path, args.int8)
+            status = 'OK' if result['max_abs_diff'] <= tolerance else 'FAILED'
+            failed = failed or status == 'FAILED'
+            print('[INFO] {} max abs diff {:.2e} label agreement {:.3f} {}'.format(
+                path, result['max_abs_diff'], result['label_agreement'], status))
+        if args.check:
+            result = check(path)
+            status = 'OK' if result['max_abs_diff'] <= 1e-4 and result['int8_max_abs_diff'] <= 5e-2 else 'FAILED'
+            failed = failed or status == 'FAILED'
+            print('[INFO] {} float32 max abs diff {:.2e} label agreement {:.3f}, '
+                  'int8 max abs diff {:.2e} label agreement {:.3f} {}'.format(
+                      path, result['max_abs_diff'], result['label_agreement'],
+                      result['int8_max_abs_diff'], result['int8_label_agreement'], status))
+    
+    sys.exit(1 if failed else 0)
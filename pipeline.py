@@ -11,17 +11,24 @@ GitHub: https://github.com/prasunroy/air-writing
 # imports
 from __future__ import division
 
+import collections
+import concurrent.futures
+import time
+
 import cv2
 import numpy
 
+from instrumentation import instruments
 from recognizer import Recognizer
+from tracker import KalmanTracker
+from trajectory import GlyphSegmenter, StrokeCanvas, Trajectory
 
 
 # Pipeline class
 class Pipeline(object):
     
     # ~~~~~~~~ constructor ~~~~~~~~
-    def __init__(self):
+    def __init__(self, backend='keras', quantize=False, recognizer=None):
         # lower and upper bound for marker color
         self._lower_hue_0 = numpy.array([80, 90, 100])
         self._lower_hue_1 = numpy.array([120, 255, 255])
@@ -31,177 +38,897 @@ class Pipeline(object):
         # image processing kernels
         self._kernel_median_blur = 27
         self._kernel_dilate_mask = (9, 9)
+        self._kernel_morph_open = (5, 5)
+        
+        # segmentation quality tiers
+        # -- 'reference' median blur, O(k) per pixel, slowest --
+        # -- 'high' box filter thresholded at half, O(1) per pixel, same mask as median on binary masks --
+        # -- 'low' morphological opening with small kernel, removes speckles only, cheapest --
+        self._quality_tiers = {
+            'reference': 'median',
+            'high': 'box',
+            'low': 'open'
+        }
+        self._quality_tier = 'reference'
         
         # marker properties
-        self._x = -1
-        self._y = -1
-        self._dx = 0
-        self._dy = 0
+        # -- velocity in pixels per second measured over history in seconds --
         self._vx = 0
         self._vy = 0
-        self._histdx = []
-        self._histdy = []
-        self._points = []
         self._max_points = 50
         self._min_change = 10
-        self._min_veloxy = 2.0
+        self._min_veloxy = 40.0
+        self._history = 1.0
+        self._trajectory = Trajectory(self._history, max_points=self._max_points)
+        self._canvas = StrokeCanvas(thickness=4)
         self._marker_ctr = None
         self._marker_tip = None
+        self._marker_blob = None
+        self._tip_band = 3
         
-        # frames per second
-        self._fps = 20
+        # marker localization
+        # -- 'components' labels connected components, cheapest on cluttered masks --
+        # -- 'contours' traces outer contours, cheapest on clean masks --
+        self._localization = 'components'
+        self._labels = None
         
         # render elements
         self._render_marker = True
         self._render_trails = True
+        self._color_marker = (255, 255, 0)
+        self._color_trails = (255, 255, 0)
+        
+        # frame format
+        # -- color order of input frames ('RGB' or 'BGR') --
+        # -- flip code applied to strokes when input frames are not mirrored --
+        self._color_order = 'RGB'
+        self._color_to_hsv = cv2.COLOR_RGB2HSV
+        self._stroke_flip = None
+        
+        # reusable buffers
+        self._frame_hsv = None
+        self._mask_0 = None
+        self._mask_1 = None
+        self._mask_roi = None
+        self._frame_small = None
+        
+        # marker tracking
+        # -- search a window around the last marker tip instead of full frame --
+        # -- window half-size is margin + factor * displacement per frame --
+        self._tracking = False
+        self._search_margin = 64
+        self._search_factor = 4.0
+        self._frames_total = 0
+        self._frames_roi = 0
+        self._roi_fallbacks = 0
+        
+        # multi-resolution detection
+        # -- coarse detection on frame downscaled by detection scale --
+        # -- refinement on full resolution patch around candidate tip --
+        self._detection_scale = 1.0
+        self._refine_margin = 16
+        self._timings = {}
+        
+        # timings of pipeline stages in last frame
+        self._stage_timings = {}
+        
+        # streaming recognition
+        # -- glyphs are cut at pen lifts while writing and recognized from their points --
+        # -- recognized glyphs of the current stroke form a running text --
+        self._segmenter = None
+        self._text = ''
+        
+        # session recording
+        # -- marker tips, blob stats and recognition events of every frame, see session.py --
+        self._recorder = None
+        
+        # instrumentation
+        # -- rolling stage timings and counters while enabled, see instrumentation.py --
+        # -- an injected recognizer keeps its own instrumentation --
+        self._instruments = instruments
+        
+        # predictive tracking
+        # -- kalman filter smooths marker tip and bridges short dropouts --
+        # -- full detection runs every n-th frame, other frames are predicted --
+        self._tracker = None
+        self._detect_every = 1
+        self._verify_skipped = True
+        self._frames_tracked = 0
+        self._frames_skipped = 0
+        self._frames_carried = 0
         
         # recognizer
-        self._recognizer = Recognizer()
+        # -- vector glyphs are rasterized from trajectory points directly --
+        # -- deferred recognition keeps the stroke while the engine model loads --
+        # -- an injected recognizer lets pipelines reuse models loaded once --
+        self._recognizer = Recognizer(backend=backend, quantize=quantize) if recognizer is None else recognizer
+        self._vector_glyphs = False
+        self._defer_recognition = False
+        
+        # asynchronous recognition
+        # -- completed strokes are classified on an executor while tracking continues --
+        # -- results are returned by later calls and reported as events with stroke id --
+        self._executor = None
+        self._own_executor = False
+        self._stroke_id = 0
+        self._pending = []
+        self._completed = collections.deque()
+        self._events = collections.deque(maxlen=1024)
         
         # opencv version
         self._opencv_version = int(cv2.__version__.split('.')[0])
         
         return
     
+    # ~~~~~~~~ marker search window ~~~~~~~~
+    def _search_window(self, frame, center):
+        if center is None:
+            return None
+        
+        # size search window from current velocity of marker
+        h, w = frame.shape[:2]
+        trajectory = self._trajectory
+        step = max(trajectory.vx * trajectory.interval, trajectory.vy * trajectory.interval, trajectory.dx, trajectory.dy)
+        r = int(self._search_margin + self._search_factor * step)
+        cx = min(max(int(center[0]), 0), w - 1)
+        cy = min(max(int(center[1]), 0), h - 1)
+        x0 = max(0, cx - r)
+        y0 = max(0, cy - r)
+        x1 = min(w, cx + r + 1)
+        y1 = min(h, cy + r + 1)
+        
+        return (x0, y0, x1, y1)
+    
+    # ~~~~~~~~ marker touches search window edge ~~~~~~~~
+    def _touches_window(self, box, roi, frame):
+        h, w = frame.shape[:2]
+        x0, y0, x1, y1 = roi
+        bx, by, bw, bh = box
+        
+        return (x0 > 0 and bx <= x0) or (y0 > 0 and by <= y0) or \
+               (x1 < w and bx + bw >= x1) or (y1 < h and by + bh >= y1)
+    
+    # ~~~~~~~~ paste search window into full frame mask ~~~~~~~~
+    def _window_mask(self, mask, roi, frame):
+        if self._mask_roi is None or self._mask_roi.shape != frame.shape[:2]:
+            self._mask_roi = numpy.zeros(frame.shape[:2], dtype='uint8')
+        else:
+            self._mask_roi.fill(0)
+        self._mask_roi[roi[1]:roi[3], roi[0]:roi[2]] = mask
+        
+        return self._mask_roi
+    
+    # ~~~~~~~~ downscale frame for detection ~~~~~~~~
+    def _downscale(self, frame, scale):
+        size = (max(1, int(frame.shape[1] * scale)), max(1, int(frame.shape[0] * scale)))
+        self._frame_small = cv2.resize(frame, size, dst=self._frame_small, interpolation=cv2.INTER_AREA)
+        
+        return self._frame_small
+    
     # ~~~~~~~~ marker segmentation ~~~~~~~~
-    def _marker_segmentation(self, frame):
-        # convert RGB to HSV color space
-        frame_hsv = cv2.cvtColor(frame, cv2.COLOR_RGB2HSV)
+    def _marker_segmentation(self, frame, roi=None, scale=1.0):
+        # scale kernels with detection scale
+        k_blur = self._kernel_median_blur
+        k_dilate = self._kernel_dilate_mask
+        if scale != 1.0:
+            k_blur = max(3, int(k_blur * scale) | 1)
+            k_dilate = (max(1, int(round(k_dilate[0] * scale))), max(1, int(round(k_dilate[1] * scale))))
         
-        # create mask for marker
-        mask_0 = cv2.inRange(frame_hsv, self._lower_hue_0, self._lower_hue_1)
-        mask_1 = cv2.inRange(frame_hsv, self._upper_hue_0, self._upper_hue_1)
+        # crop search window padded by kernel radius to avoid border effects
+        if not roi is None:
+            pad = k_blur // 2 + k_dilate[0] // 2
+            x0, y0, x1, y1 = roi
+            px0 = max(0, x0 - pad)
+            py0 = max(0, y0 - pad)
+            px1 = min(frame.shape[1], x1 + pad)
+            py1 = min(frame.shape[0], y1 + pad)
+            mask = self._marker_segmentation(frame[py0:py1, px0:px1], None, scale)
+            
+            return mask[y0-py0:y1-py0, x0-px0:x1-px0]
         
-        mask = cv2.addWeighted(mask_0, 1.0, mask_1, 1.0, 0.0)
+        # convert RGB or BGR to HSV color space
+        self._frame_hsv = cv2.cvtColor(frame, self._color_to_hsv, dst=self._frame_hsv)
+        
+        # create mask for marker evaluating each distinct hue range once
+        ranges = self._hue_ranges()
+        self._mask_0 = cv2.inRange(self._frame_hsv, ranges[0][0], ranges[0][1], dst=self._mask_0)
+        for lower, upper in ranges[1:]:
+            self._mask_1 = cv2.inRange(self._frame_hsv, lower, upper, dst=self._mask_1)
+            cv2.bitwise_or(self._mask_0, self._mask_1, dst=self._mask_0)
         
         # remove noise from mask
-        mask = cv2.medianBlur(mask, self._kernel_median_blur)
+        mask = self._denoise(self._mask_0, k_blur, self._quality_tiers[self._quality_tier])
         
         # perform dilation on mask
+        mask = cv2.dilate(mask, k_dilate)
+        
+        return mask
+    
+    # ~~~~~~~~ distinct hue ranges ~~~~~~~~
+    def _hue_ranges(self):
+        ranges = [(self._lower_hue_0, self._lower_hue_1)]
+        if not (numpy.array_equal(self._upper_hue_0, self._lower_hue_0) and
+                numpy.array_equal(self._upper_hue_1, self._lower_hue_1)):
+            ranges.append((self._upper_hue_0, self._upper_hue_1))
+        
+        return ranges
+    
+    # ~~~~~~~~ remove noise from mask ~~~~~~~~
+    def _denoise(self, mask, k_blur, backend='median'):
+        if backend == 'box':
+            mask = cv2.boxFilter(mask, -1, (k_blur, k_blur), borderType=cv2.BORDER_REPLICATE)
+            mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY, dst=mask)[1]
+        elif backend == 'open':
+            kernel = cv2.getStructuringElement(cv2.MORPH_RECT, self._kernel_morph_open)
+            mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, kernel)
+        else:
+            mask = cv2.medianBlur(mask, k_blur)
+        
+        return mask
+    
+    # ~~~~~~~~ reference marker segmentation ~~~~~~~~
+    def _marker_segmentation_reference(self, frame):
+        frame_hsv = cv2.cvtColor(frame, self._color_to_hsv)
+        mask_0 = cv2.inRange(frame_hsv, self._lower_hue_0, self._lower_hue_1)
+        mask_1 = cv2.inRange(frame_hsv, self._upper_hue_0, self._upper_hue_1)
+        mask = cv2.addWeighted(mask_0, 1.0, mask_1, 1.0, 0.0)
+        mask = cv2.medianBlur(mask, self._kernel_median_blur)
         mask = cv2.dilate(mask, self._kernel_dilate_mask)
         
         return mask
     
     # ~~~~~~~~ marker tip identification ~~~~~~~~
-    def _marker_tip_identification(self, mask):
-        # find contours in mask
-        if self._opencv_version == 2:
-            contours = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[0]
+    def _marker_tip_identification(self, mask, offset=(0, 0)):
+        # connected components are not available in opencv 2
+        if self._opencv_version == 2 or self._localization == 'contours':
+            return self._marker_tip_identification_contours(mask, offset)
+        
+        # label connected components in mask
+        if hasattr(cv2, 'connectedComponentsWithStatsWithAlgorithm'):
+            if self._labels is None or self._labels.shape != mask.shape:
+                self._labels = None
+            n, self._labels, stats, centroids = cv2.connectedComponentsWithStatsWithAlgorithm(mask, 8, cv2.CV_32S, cv2.CCL_GRANA, labels=self._labels)
         else:
-            contours = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[1]
+            n, self._labels, stats, centroids = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        labels = self._labels
+        if n < 2:
+            return [None, None, None]
         
-        # process contours
-        if contours and len(contours) > 0:
-            # find the largest contour
-            contour_max = sorted(contours, key = cv2.contourArea, reverse = True)[0]
-            
-            # find tip of marker assuming as peak of largest contour
-            contour_roi = contour_max.reshape(contour_max.shape[0], contour_max.shape[2])
-            contour_roi = sorted(contour_roi, key=lambda x:x[1])
+        # find the largest component excluding background
+        label = 1 + numpy.argmax(stats[1:, cv2.CC_STAT_AREA])
+        x, y, w, h, area = stats[label]
+        
+        # find tip of marker as left-most pixel on top row of largest component
+        # -- sub-pixel estimate averages x over the top rows of the component --
+        xs = numpy.flatnonzero(labels[y, x:x+w] == label)
+        xb = numpy.nonzero(labels[y:y+self._tip_band, x:x+w] == label)[1]
+        marker_tip = (int(x + xs[0] + offset[0]), int(y + offset[1]))
+        blob = {
+            'area': int(area),
+            'box': (int(x + offset[0]), int(y + offset[1]), int(w), int(h)),
+            'centroid': (float(centroids[label][0] + offset[0]), float(centroids[label][1] + offset[1])),
+            'tip': (float(x + xb.mean() + offset[0]), float(y + offset[1]))
+        }
+        
+        # trace outline of largest component for rendering only
+        contour = None
+        if self._render_marker:
+            component = numpy.uint8(labels[y:y+h, x:x+w] == label)
+            offset_box = (int(x + offset[0]), int(y + offset[1]))
+            # -- contours are the second last return value in opencv 3 and 4 --
+            contour = cv2.findContours(component, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=offset_box)[-2][0]
+        
+        return [contour, marker_tip, blob]
+    
+    # ~~~~~~~~ marker tip identification using contours ~~~~~~~~
+    def _marker_tip_identification_contours(self, mask, offset=(0, 0)):
+        # find contours in mask
+        contours = cv2.findContours(mask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE, offset=offset)[-2]
+        if not contours or len(contours) == 0:
+            return [None, None, None]
+        
+        # find the largest contour
+        areas = numpy.array([cv2.contourArea(c) for c in contours])
+        contour = contours[numpy.argmax(areas)]
+        
+        # find tip of marker as top-most point of largest contour
+        points = contour.reshape(-1, 2)
+        i = numpy.argmin(points[:, 1])
+        marker_tip = (int(points[i][0]), int(points[i][1]))
+        moments = cv2.moments(contour)
+        blob = {
+            'area': int(numpy.max(areas)),
+            'box': cv2.boundingRect(contour),
+            'centroid': (moments['m10'] / moments['m00'], moments['m01'] / moments['m00']) if moments['m00'] > 0 else marker_tip,
+            'tip': (float(points[points[:, 1] == marker_tip[1], 0].mean()), float(marker_tip[1]))
+        }
+        
+        return [contour, marker_tip, blob]
+    
+    
+    # ~~~~~~~~ marker tip refinement ~~~~~~~~
+    def _marker_tip_refinement(self, frame, marker_tip, scale):
+        # search full resolution patch around candidate tip
+        h, w = frame.shape[:2]
+        r = int(self._refine_margin + 2.0 / scale)
+        cx = int(marker_tip[0] / scale)
+        cy = int(marker_tip[1] / scale)
+        roi = (max(0, cx - r), max(0, cy - r), min(w, cx + r + 1), min(h, cy + r + 1))
+        mask = self._marker_segmentation(frame, roi)
+        contour, marker_tip, blob = self._marker_tip_identification(mask, (roi[0], roi[1]))
+        if marker_tip is None:
+            return [(cx, cy), (float(cx), float(cy))]
+        
+        return [marker_tip, blob['tip']]
+    
+    # ~~~~~~~~ marker detection ~~~~~~~~
+    def _marker_detection(self, frame, center=None):
+        self._frames_total += 1
+        scale = self._detection_scale
+        t_seg = 0.0
+        t_idn = 0.0
+        t_ref = 0.0
+        
+        # downscale frame for coarse detection
+        t = time.perf_counter()
+        image = frame if scale == 1.0 else self._downscale(frame, scale)
+        t_seg += time.perf_counter() - t
+        
+        # search window around last marker tip in tracking mode or given center
+        if not center is None:
+            roi = self._search_window(frame, center)
+        else:
+            roi = self._search_window(frame, self._marker_tip) if self._tracking else None
+        if not roi is None:
+            self._frames_roi += 1
+            if scale != 1.0:
+                roi = (int(roi[0] * scale), int(roi[1] * scale),
+                       min(image.shape[1], int(roi[2] * scale) + 1), min(image.shape[0], int(roi[3] * scale) + 1))
+            t = time.perf_counter()
+            mask = self._marker_segmentation(image, roi, scale)
+            t_seg += time.perf_counter() - t
+            t = time.perf_counter()
+            contour, marker_tip, blob = self._marker_tip_identification(mask, (roi[0], roi[1]))
+            t_idn += time.perf_counter() - t
             
-            marker_tip = (contour_roi[0][0], contour_roi[0][1])
+            # fall back to full frame if marker is lost or touches window edge
+            if marker_tip is None or self._touches_window(blob['box'], roi, image):
+                self._roi_fallbacks += 1
+                roi = None
+            else:
+                mask = self._window_mask(mask, roi, image)
+        
+        # full frame search
+        if roi is None:
+            t = time.perf_counter()
+            mask = self._marker_segmentation(image, None, scale)
+            t_seg += time.perf_counter() - t
+            t = time.perf_counter()
+            contour, marker_tip, blob = self._marker_tip_identification(mask)
+            t_idn += time.perf_counter() - t
+        
+        # refine marker tip at full resolution
+        if scale != 1.0 and not marker_tip is None:
+            t = time.perf_counter()
+            marker_tip, tip = self._marker_tip_refinement(frame, marker_tip, scale)
+            if not contour is None:
+                contour = numpy.int32(contour / scale)
+            blob = {
+                'area': int(blob['area'] / (scale * scale)),
+                'box': tuple(int(v / scale) for v in blob['box']),
+                'centroid': (blob['centroid'][0] / scale, blob['centroid'][1] / scale),
+                'tip': tip
+            }
+            t_ref += time.perf_counter() - t
+        self._marker_blob = blob
+        
+        # timings of detection stages in seconds
+        self._timings['scale'] = scale
+        self._timings['segmentation'] = t_seg
+        self._timings['identification'] = t_idn
+        self._timings['refinement'] = t_ref
+        
+        return [mask, contour, marker_tip]
+    
+    # ~~~~~~~~ predictive marker tracking ~~~~~~~~
+    def _marker_tracking(self, frame):
+        self._frames_tracked += 1
+        predicted = self._tracker.predict()
+        
+        # run full detection every n-th frame and predict frames in between
+        if not predicted is None and self._frames_tracked % self._detect_every != 0:
+            self._frames_skipped += 1
+            if self._verify_skipped:
+                mask, contour, marker_tip = self._marker_detection(frame, center=predicted)
+            else:
+                return [None, None, predicted]
+        else:
+            mask, contour, marker_tip = self._marker_detection(frame)
+        
+        # smooth marker tip or carry track through short dropouts
+        if not marker_tip is None:
+            marker_tip = self._tracker.correct(marker_tip)
+            if self._tracker.restarted:
+                # marker found away from carried track ends the stroke as a lost marker would
+                self._trajectory_approximation(None, frame.shape, None)
         else:
-            contour_max = None
-            marker_tip = None
+            marker_tip = self._tracker.miss()
+            if not marker_tip is None:
+                self._frames_carried += 1
         
-        return [contour_max, marker_tip]
+        return [mask, contour, marker_tip]
     
     # ~~~~~~~~ trajectory approximation ~~~~~~~~
-    def _trajectory_approximation(self, marker_tip, frame):
+    def _trajectory_approximation(self, marker_tip, shape, timestamp):
         image = None
         if marker_tip is None:
             # reset marker
-            self._x = -1
-            self._y = -1
-            self._dx = 0
-            self._dy = 0
+            self._trajectory.reset()
+            self._canvas.reset()
             self._vx = 0
             self._vy = 0
-            self._histdx = []
-            self._histdy = []
-            self._points = []
         else:
-            # check buffers
-            if len(self._histdx) >= self._fps:
-                self._histdx.pop(0)
-            if len(self._histdy) >= self._fps:
-                self._histdy.pop(0)
-            if len(self._points) > self._max_points:
-                self._points.pop(0)
-            
             # update position and velocity of marker
-            if self._x < 0 or self._y < 0:
-                self._x, self._y = marker_tip
-            self._dx = abs(marker_tip[0] - self._x)
-            self._dy = abs(marker_tip[1] - self._y)
-            self._histdx.append(self._dx)
-            self._histdy.append(self._dy)
-            if self._dx > self._min_change or self._dy > self._min_change:
-                self._points.append(marker_tip)
-            self._x, self._y = marker_tip
+            nodes = len(self._trajectory)
+            self._trajectory.window = self._history
+            added = self._trajectory.update(marker_tip, timestamp, self._min_change, self._max_points)
+            self._vx = self._trajectory.vx
+            self._vy = self._trajectory.vy
             
-            self._vx = numpy.floor(sum(self._histdx[-self._fps:]) / self._fps)
-            self._vy = numpy.floor(sum(self._histdy[-self._fps:]) / self._fps)
+            # draw newest segment of trajectory on stroke canvas
+            # -- whole stroke is redrawn only when its oldest point was dropped --
+            self._canvas.allocate(shape[:2])
+            if len(self._trajectory) < nodes + added:
+                self._canvas.redraw(self._trajectory.points())
+            elif added and len(self._trajectory) > 1:
+                self._canvas.draw(self._trajectory.last(2), self._trajectory.last(1))
             
-            # draw trajectory of marker if marker is in static state
-            nodes = len(self._points)
-            if nodes > 1:
-                image = numpy.zeros((frame.shape[0], frame.shape[1]), dtype='uint8')
-                for i in range(nodes-1):
-                    cv2.line(image, self._points[i], self._points[i+1], (255, 255, 255), 4, cv2.LINE_AA)
+            # crop trajectory of marker at its bounding box
+            if len(self._trajectory) > 1:
+                image = self._canvas.crop()
         
         return image
     
     # ~~~~~~~~ character recognition ~~~~~~~~
-    def _character_recognition(self, image, engine, mapping):
+    def _character_recognition(self, image, engine, mapping, points=None):
+        if not points is None:
+            points = numpy.array(points)
+            if self._stroke_flip in (1, -1):
+                points[:, 0] = -points[:, 0]
+            if self._stroke_flip in (0, -1):
+                points[:, 1] = -points[:, 1]
+            return self._recognizer.predict_points(points, engine, mapping)
+        if type(self._stroke_flip) is int:
+            image = cv2.flip(image, self._stroke_flip)
         predictions = self._recognizer.predict(image, engine, mapping)
         
         return predictions
     
+    # ~~~~~~~~ check if recognizer is ready for engine ~~~~~~~~
+    def _recognizer_ready(self, engine):
+        if not self._defer_recognition or self._recognizer.is_ready(engine):
+            return True
+        self._recognizer.preload([engine])
+        
+        return False
+    
+    # ~~~~~~~~ recognize stroke and report event ~~~~~~~~
+    def _recognize_stroke(self, stroke_id, image, engine, mapping, points, timestamp, t_submit, glyph=None):
+        try:
+            prediction, predprobas = self._character_recognition(image, engine, mapping, points)
+            error = None
+        except Exception as e:
+            prediction, predprobas = [None, None]
+            error = e
+        self._instruments.count('recognitions' if error is None else 'recognition_errors')
+        event = {
+            'stroke': stroke_id,
+            'engine': engine,
+            'timestamp': timestamp,
+            'prediction': prediction,
+            'confidence': predprobas,
+            'latency': time.perf_counter() - t_submit
+        }
+        if not error is None:
+            event['error'] = error
+        
+        # running text of glyphs in stroke
+        # -- glyphs complete in order as the executor runs one task at a time --
+        if not glyph is None:
+            index, final = glyph
+            if index == 0:
+                self._text = ''
+            if not prediction is None:
+                self._text += ''.join(str(p) for p in prediction)
+            event['glyph'] = index
+            event['final'] = final
+            event['text'] = self._text
+        if self._instruments.enabled:
+            self._instruments.record('recognition_latency', event['latency'])
+        recorder = self._recorder
+        if not recorder is None:
+            recorder.append_event(event)
+        self._events.append(event)
+        
+        return event
+    
+    # ~~~~~~~~ submit completed stroke for recognition ~~~~~~~~
+    def _submit_stroke(self, image, engine, mapping, points, timestamp, glyph=None):
+        self._stroke_id += 1
+        self._instruments.count('strokes' if glyph is None else 'glyphs')
+        t_submit = time.perf_counter()
+        if self._executor is None:
+            event = self._recognize_stroke(self._stroke_id, image, engine, mapping, points, timestamp, t_submit, glyph)
+            if 'error' in event:
+                raise event['error']
+            if not glyph is None:
+                self._completed.append(event)
+            return [event['prediction'], event['confidence']]
+        
+        # stroke image is copied as the canvas is cleared for the next stroke
+        future = self._executor.submit(self._recognize_stroke, self._stroke_id, None if image is None else image.copy(),
+                                       engine, mapping, points, timestamp, t_submit, glyph)
+        future.add_done_callback(self._stroke_done)
+        self._pending.append(future)
+        
+        return [None, None]
+    
+    # ~~~~~~~~ streaming recognition of glyphs ~~~~~~~~
+    def _stream_glyphs(self, marker_tip, image, engine, mapping, timestamp):
+        segmenter = self._segmenter
+        segmenter.direction = -1 if self._stroke_flip in (1, -1) else 1
+        
+        # unfinished glyph is discarded with the stroke when the marker is lost
+        if marker_tip is None:
+            segmenter.reset()
+        else:
+            points = segmenter.update(marker_tip, timestamp, self._min_change)
+            if not points is None:
+                self._submit_stroke(None, engine, mapping, points, timestamp, (segmenter.glyphs - 1, False))
+        
+        # pause completes the last glyph of stroke
+        if not image is None and self._vx < self._min_veloxy and self._vy < self._min_veloxy and self._recognizer_ready(engine):
+            index = segmenter.glyphs
+            points = segmenter.finish()
+            if len(points) > 1:
+                self._submit_stroke(None, engine, mapping, points, timestamp, (index, True))
+            self._reset_stroke()
+        
+        return
+    
+    # ~~~~~~~~ reset marker after recognized stroke ~~~~~~~~
+    def _reset_stroke(self):
+        self._trajectory.reset()
+        self._canvas.reset()
+        self._vx = 0
+        self._vy = 0
+        self._marker_ctr = None
+        self._marker_tip = None
+        self._marker_blob = None
+        if not self._tracker is None:
+            self._tracker.reset()
+        
+        return
+    
+    # ~~~~~~~~ collect completed recognition ~~~~~~~~
+    def _stroke_done(self, future):
+        event = future.result()
+        if not 'error' in event:
+            self._completed.append(event)
+        
+        return
+    
+    # ~~~~~~~~ oldest completed recognition not returned yet ~~~~~~~~
+    def _next_completed(self):
+        self._pending = [future for future in self._pending if not future.done()]
+        try:
+            event = self._completed.popleft()
+        except IndexError:
+            return [None, None]
+        
+        return [event['prediction'], event['confidence']]
+    
     # ~~~~~~~~ render frame ~~~~~~~~
     def _render(self, frame):
         if not self._marker_ctr is None:
             cv2.drawContours(frame, self._marker_ctr, -1, (0, 255, 0), 1)
         if not self._marker_tip is None:
-            cv2.circle(frame, self._marker_tip, 4, (255, 255, 0), -1)
-        n = len(self._points)
-        if n > 1:
-            for i in range(n-1):
-                cv2.line(frame, self._points[i], self._points[i+1], (255, 255, 0), 4, cv2.LINE_AA)
+            cv2.circle(frame, self._marker_tip, 4, self._color_marker, -1)
+        box = self._canvas.box()
+        if not box is None and len(self._trajectory) > 1:
+            x0, y0, x1, y1 = box
+            region = frame[y0:y1, x0:x1]
+            region[self._canvas.crop() > 127] = self._color_trails
         
         return frame
     
-    # ~~~~~~~~ run inference ~~~~~~~~
-    def run_inference(self, frame, engine='EN', mapping=True):
-        # STEP-A: marker segmentation
-        mask = self._marker_segmentation(frame)
+    # ~~~~~~~~ set frame format ~~~~~~~~
+    def set_frame_format(self, color_order='RGB', stroke_flip=None):
+        self._color_order = color_order.upper()
+        self._stroke_flip = stroke_flip
+        if self._color_order == 'BGR':
+            self._color_to_hsv = cv2.COLOR_BGR2HSV
+            self._color_marker = (0, 255, 255)
+            self._color_trails = (0, 255, 255)
+        else:
+            self._color_to_hsv = cv2.COLOR_RGB2HSV
+            self._color_marker = (255, 255, 0)
+            self._color_trails = (255, 255, 0)
         
-        # STEP-B: marker tip identification
-        self._marker_ctr, self._marker_tip = self._marker_tip_identification(mask)
+        return
+    
+    # ~~~~~~~~ enable or disable tracking mode ~~~~~~~~
+    def set_tracking(self, enabled=True):
+        self._tracking = enabled
+        
+        return
+    
+    # ~~~~~~~~ enable or disable predictive tracking ~~~~~~~~
+    def set_predictive_tracking(self, enabled=True, detect_every=1, verify_skipped=True, max_misses=5):
+        # frames between full detections verify the predicted tip in a search window
+        # -- a miss in the window falls back to full frame detection --
+        # -- unverified frames use the extrapolated tip, which overshoots corners of strokes --
+        self._tracker = KalmanTracker(max_misses=max_misses) if enabled else None
+        self._detect_every = max(1, int(detect_every))
+        self._verify_skipped = verify_skipped
+        
+        return
+    
+    # ~~~~~~~~ tracking statistics ~~~~~~~~
+    def get_tracking_stats(self):
+        stats = {
+            'frames': self._frames_total,
+            'roi_frames': self._frames_roi,
+            'fallbacks': self._roi_fallbacks,
+            'fallback_rate': self._roi_fallbacks / self._frames_roi if self._frames_roi > 0 else 0.0,
+            'skipped_frames': self._frames_skipped,
+            'carried_frames': self._frames_carried
+        }
+        
+        return stats
+    
+    # ~~~~~~~~ set segmentation quality tier ~~~~~~~~
+    def set_quality_tier(self, tier='reference'):
+        if not tier in self._quality_tiers:
+            raise ValueError('unknown quality tier: {}'.format(tier))
+        self._quality_tier = tier
+        
+        return
+    
+    # ~~~~~~~~ compare quality tiers with reference segmentation ~~~~~~~~
+    def compare_quality_tiers(self, frame):
+        reference = self._marker_segmentation_reference(frame) > 0
+        tier = self._quality_tier
+        scores = {}
+        for name in self._quality_tiers:
+            self._quality_tier = name
+            mask = self._marker_segmentation(frame) > 0
+            union = numpy.count_nonzero(reference | mask)
+            scores[name] = {
+                'iou': float(numpy.count_nonzero(reference & mask) / union) if union > 0 else 1.0,
+                'mismatch': float(numpy.count_nonzero(reference ^ mask) / mask.size)
+            }
+        self._quality_tier = tier
+        
+        return scores
+    
+    # ~~~~~~~~ set detection scale ~~~~~~~~
+    def set_detection_scale(self, scale=1.0):
+        self._detection_scale = min(1.0, max(0.05, float(scale)))
+        
+        return
+    
+    # ~~~~~~~~ detection timings ~~~~~~~~
+    def get_detection_timings(self):
+        return dict(self._timings)
+    
+    # ~~~~~~~~ enable or disable deferred recognition ~~~~~~~~
+    def set_deferred_recognition(self, enabled=True):
+        self._defer_recognition = enabled
+        
+        return
+    
+    # ~~~~~~~~ enable or disable asynchronous recognition ~~~~~~~~
+    def set_async_recognition(self, enabled=True, executor=None):
+        # -- the recognizer is not thread-safe so a given executor must run one task at a time --
+        self.wait_recognition()
+        if self._own_executor:
+            self._executor.shutdown(wait=True)
+        self._executor = None
+        self._own_executor = False
+        if enabled:
+            self._executor = executor if not executor is None else concurrent.futures.ThreadPoolExecutor(max_workers=1)
+            self._own_executor = executor is None
+        
+        return
+    
+    # ~~~~~~~~ enable or disable streaming recognition ~~~~~~~~
+    def set_streaming_recognition(self, enabled=True, **options):
+        # -- options are passed to GlyphSegmenter, see trajectory.py --
+        self.wait_recognition()
+        self._segmenter = GlyphSegmenter(**options) if enabled else None
+        self._text = ''
+        
+        return
+    
+    # ~~~~~~~~ running text of recognized glyphs in current stroke ~~~~~~~~
+    def get_text(self):
+        return self._text
+    
+    # ~~~~~~~~ wait for pending recognition ~~~~~~~~
+    def wait_recognition(self, timeout=None):
+        concurrent.futures.wait(self._pending, timeout)
+        self._pending = [future for future in self._pending if not future.done()]
+        
+        return len(self._pending) == 0
+    
+    # ~~~~~~~~ recognition events since last call ~~~~~~~~
+    def get_events(self):
+        events = []
+        while True:
+            try:
+                events.append(self._events.popleft())
+            except IndexError:
+                break
+        
+        return events
+    
+    # ~~~~~~~~ load recognition models on background thread ~~~~~~~~
+    def preload_models(self, engines=None):
+        self._recognizer.preload(engines)
+        
+        return
+    
+    # ~~~~~~~~ recognition model load times ~~~~~~~~
+    def get_model_load_times(self):
+        return self._recognizer.get_load_times()
+    
+    # ~~~~~~~~ resident memory added by recognition model loads ~~~~~~~~
+    def get_model_load_memory(self):
+        return self._recognizer.get_load_memory()
+    
+    # ~~~~~~~~ check if no stroke or track carries over to next frame ~~~~~~~~
+    def is_idle(self):
+        return self._marker_tip is None and len(self._trajectory) == 0 and \
+               (self._tracker is None or not self._tracker.is_active())
+    
+    # ~~~~~~~~ marker motion state ~~~~~~~~
+    def get_motion_state(self):
+        if self._marker_tip is None:
+            return 'lost'
+        if self._vx < self._min_veloxy and self._vy < self._min_veloxy:
+            return 'still'
+        
+        return 'moving'
+    
+    # ~~~~~~~~ stage timings ~~~~~~~~
+    def get_stage_timings(self):
+        return dict(self._stage_timings)
+    
+    # ~~~~~~~~ set instrumentation ~~~~~~~~
+    def set_instrumentation(self, instrumentation):
+        self._instruments = instrumentation
+        
+        return
+    
+    # ~~~~~~~~ stroke settings ~~~~~~~~
+    def get_stroke_settings(self):
+        return {
+            'min_change': self._min_change,
+            'min_veloxy': self._min_veloxy,
+            'max_points': self._max_points,
+            'history': self._history,
+            'stroke_flip': self._stroke_flip,
+            'vector_glyphs': self._vector_glyphs
+        }
+    
+    # ~~~~~~~~ set stroke settings ~~~~~~~~
+    def set_stroke_settings(self, settings):
+        for name, value in settings.items():
+            if not name in ('min_change', 'min_veloxy', 'max_points', 'history', 'stroke_flip', 'vector_glyphs'):
+                raise ValueError('unknown stroke setting: {}'.format(name))
+            setattr(self, '_' + name, value)
+        
+        return
+    
+    # ~~~~~~~~ set session recorder ~~~~~~~~
+    def set_recorder(self, recorder):
+        self._recorder = recorder
+        
+        return
+    
+    # ~~~~~~~~ record marker tip of frame ~~~~~~~~
+    def _record_frame(self, shape, timestamp, blob):
+        if not self._recorder.started:
+            self._recorder.start(self.get_stroke_settings(), shape)
+        self._recorder.append(timestamp, self._marker_tip, blob)
+        
+        return
+    
+    # ~~~~~~~~ report stage timings and detection state ~~~~~~~~
+    def _instrument_frame(self, detected, found, marker_found):
+        instruments = self._instruments
+        instruments.count('frames')
+        if detected:
+            instruments.record('segmentation', self._timings.get('segmentation', 0.0))
+            instruments.record('identification', self._timings.get('identification', 0.0))
+            if self._detection_scale != 1.0:
+                instruments.record('refinement', self._timings.get('refinement', 0.0))
+        for stage, seconds in self._stage_timings.items():
+            instruments.record(stage, seconds)
+        instruments.record('frame', sum(self._stage_timings.values()))
+        
+        # marker lost after it was found in previous frame
+        if found and not marker_found:
+            instruments.count('detection_losses')
+        
+        return
+    
+    # ~~~~~~~~ run trajectory approximation and recognition on marker tip ~~~~~~~~
+    def run_tracking(self, marker_tip, shape, engine='EN', mapping=True, timestamp=None):
+        # capture time of frame in seconds
+        if timestamp is None:
+            timestamp = time.monotonic()
+        self._marker_tip = marker_tip
         
         # STEP-C: trajectory approximation
-        image = self._trajectory_approximation(self._marker_tip, frame)
+        t_1 = time.perf_counter()
+        image = self._trajectory_approximation(marker_tip, shape, timestamp)
         
         # STEP-D: character recognition
-        if not image is None and self._vx < self._min_veloxy and self._vy < self._min_veloxy:
-            prediction, predprobas = self._character_recognition(image, engine, mapping)
-            
-            # reset marker
-            self._x = -1
-            self._y = -1
-            self._dx = 0
-            self._dy = 0
-            self._vx = 0
-            self._vy = 0
-            self._histdx = []
-            self._histdy = []
-            self._points = []
-            self._marker_ctr = None
-            self._marker_tip = None
+        t_2 = time.perf_counter()
+        prediction, predprobas = [None, None]
+        if not self._segmenter is None:
+            self._stream_glyphs(marker_tip, image, engine, mapping, timestamp)
+        elif not image is None and self._vx < self._min_veloxy and self._vy < self._min_veloxy and self._recognizer_ready(engine):
+            points = self._trajectory.points() if self._vector_glyphs else None
+            prediction, predprobas = self._submit_stroke(image, engine, mapping, points, timestamp)
+            self._reset_stroke()
+        if not self._executor is None or not self._segmenter is None:
+            prediction, predprobas = self._next_completed()
+        t_3 = time.perf_counter()
+        
+        # timings of pipeline stages in seconds
+        self._stage_timings['trajectory'] = t_2 - t_1
+        self._stage_timings['recognition'] = t_3 - t_2
+        
+        return [prediction, predprobas]
+    
+    # ~~~~~~~~ run inference ~~~~~~~~
+    def run_inference(self, frame, engine='EN', mapping=True, timestamp=None, render=True):
+        # capture time of frame in seconds
+        if timestamp is None:
+            timestamp = time.monotonic()
+        
+        # STEP-A: marker segmentation
+        # STEP-B: marker tip identification
+        found = not self._marker_tip is None
+        t_0 = time.perf_counter()
+        if self._tracker is None:
+            mask, self._marker_ctr, self._marker_tip = self._marker_detection(frame)
         else:
-            prediction, predprobas = [None, None]
+            mask, self._marker_ctr, self._marker_tip = self._marker_tracking(frame)
+        t_1 = time.perf_counter()
+        marker_found = not self._marker_tip is None
+        
+        # record marker tip before it is consumed by recognition
+        if not self._recorder is None:
+            self._record_frame(frame.shape, timestamp, self._marker_blob if not mask is None else None)
+        
+        # STEP-C: trajectory approximation
+        # STEP-D: character recognition
+        prediction, predprobas = self.run_tracking(self._marker_tip, frame.shape, engine, mapping, timestamp)
         
         # render frame
-        frame = self._render(frame)
+        t_3 = time.perf_counter()
+        if render:
+            frame = self._render(frame)
+        t_4 = time.perf_counter()
+        
+        # timings of pipeline stages in seconds
+        self._stage_timings['detection'] = t_1 - t_0
+        self._stage_timings['render'] = t_4 - t_3
+        if self._instruments.enabled:
+            self._instrument_frame(not mask is None, found, marker_found)
         
         return [prediction, predprobas, mask, frame]
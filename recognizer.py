@@ -16,51 +16,136 @@ import os
 os.environ["MKL_THREADING_LAYER"] = "GNU"
 
 # -- main modules --
+import argparse
+import collections
+import hashlib
+import sys
+import threading
+import time
+
 import cv2
 import numpy
 
-from keras.models import Sequential
-from keras.layers import Dense
-from keras.layers import Dropout
-from keras.layers import Flatten
-from keras.layers.convolutional import Conv2D
-from keras.layers.convolutional import MaxPooling2D
-from keras import backend
-
 import mapper
+import npcnn
+from instrumentation import instruments
 
 
-# setup backend
-backend.set_image_dim_ordering('th')
+# ~~~~~~~~ resident memory of process in megabytes ~~~~~~~~
+def _resident_memory():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1048576.0
+    except (IOError, OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # peak resident memory in kilobytes on linux and bytes on macos
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / 1048576.0 if sys.platform == 'darwin' else rss / 1024.0
+    except ImportError:
+        return 0.0
 
 
 # Recognizer class
 class Recognizer(object):
     
     # ~~~~~~~~ constructor ~~~~~~~~
-    def __init__(self):
+    def __init__(self, engines=('EN',), backend='keras', quantize=False, inference_only=True, cache=True,
+                 shared_weights=False):
         # model properties
         self._i_shape = (1, 56, 56)
         self._b_shape = (1, 40, 40)
         self._n_class = 10
-        self._path_en = 'models/en_numbers_ft.h5'
-        self._path_bn = 'models/bn_numbers_ft.h5'
-        self._path_dv = 'models/dv_numbers_ft.h5'
-        self._model_en = self._cnn(self._i_shape, self._n_class, self._path_en)
-        self._model_bn = self._cnn(self._i_shape, self._n_class, self._path_bn)
-        self._model_dv = self._cnn(self._i_shape, self._n_class, self._path_dv)
+        self._paths = {
+            'EN': 'models/en_numbers_ft.h5',
+            'BN': 'models/bn_numbers_ft.h5',
+            'DV': 'models/dv_numbers_ft.h5'
+        }
+        
+        # inference backend
+        # -- 'numpy' runs exported weights without keras, optionally int8 quantized --
+        if not backend in ('keras', 'numpy'):
+            raise ValueError('unknown backend: {}'.format(backend))
+        self._backend = backend
+        self._quantize = quantize
+        
+        # model construction
+        # -- inference-only models are not compiled and hold no optimizer state --
+        # -- cached weights are converted once and memory-mapped on later loads --
+        self._inference_only = inference_only
+        self._cache = cache
+        
+        # shared weights
+        # -- weights stay read-only memory-mapped views of the cache without copies --
+        # -- processes mapping the same cache share one copy in the page cache --
+        # -- workers forked after loading inherit the mappings directly --
+        if shared_weights and backend != 'numpy':
+            raise ValueError('shared weights require numpy backend')
+        self._shared_weights = shared_weights
+        if shared_weights:
+            self._cache = True
+        
+        # lazy model loading
+        # -- only the given engines load here, the others on first use --
+        # -- preload loads models on a background thread --
+        self._models = {}
+        self._load_times = {}
+        self._load_memory = {}
+        self._load_lock = threading.Lock()
+        self._preload_lock = threading.Lock()
+        self._preload_queue = []
+        self._preloader = None
+        for engine in engines:
+            self._model(engine)
         
         # image processing
         self._min_size = 8
         self._d_kernel = (3, 3)
         
+        # direct rasterization of stroke points
+        # -- glyph and input tensor buffers are reused across predictions --
+        # -- matches raster path within 0.05 mean absolute input difference --
+        self._glyph = numpy.zeros((self._i_shape[2], self._i_shape[1]), dtype='uint8')
+        self._glyph_input = numpy.zeros((1,) + self._i_shape, dtype='float32')
+        self._glyph_shift = 4
+        
+        # batch of preprocessed glyphs
+        self._batch = numpy.zeros((4,) + self._i_shape, dtype='float32')
+        
         # opencv version
         self._opencv_version = int(cv2.__version__.split('.')[0])
         
+        # prediction timings
+        self._instruments = instruments
+        
+        # prediction cache
+        # -- disabled unless a size is set, see set_prediction_cache --
+        self._cache_size = 0
+        self._cache_grid = 56
+        self._cache_levels = 256
+        self._cache_audit_every = 0
+        self._cache_entries = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._cache_stats = {}
+        self.clear_prediction_cache()
+        
         return
     
     # ~~~~~~~~ CNN architecture ~~~~~~~~
     def _cnn(self, i_shape=(1, 28, 28), n_class=10, weights=None):
+        # keras is imported on first model load
+        from keras.models import Sequential
+        from keras.layers import Dense
+        from keras.layers import Dropout
+        from keras.layers import Flatten
+        from keras.layers.convolutional import Conv2D
+        from keras.layers.convolutional import MaxPooling2D
+        from keras import backend
+        
+        # setup backend
+        backend.set_image_dim_ordering('th')
+        
         model = Sequential()
         model.add(Conv2D(filters=32, kernel_size=(5, 5), activation='relu', input_shape=i_shape))
         model.add(MaxPooling2D(pool_size=(2, 2)))
@@ -71,13 +156,112 @@ class Recognizer(object):
         model.add(Dense(units=128, activation='relu'))
         model.add(Dense(units=64, activation='relu'))
         model.add(Dense(units=n_class, activation='softmax'))
-        model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+        if not self._inference_only:
+            model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
         
         if not weights is None and os.path.isfile(weights):
-            model.load_weights(weights)
+            if self._cache:
+                self._load_cached_weights(model, weights, backend.backend())
+            else:
+                model.load_weights(weights)
+        
+        return model
+    
+    # ~~~~~~~~ load weights through converted weight cache ~~~~~~~~
+    def _load_cached_weights(self, model, path, backend_name):
+        shapes = [w.shape for w in model.get_weights()]
+        
+        # weights converted by keras for current backend as one flat array
+        def build():
+            model.load_weights(path)
+            return numpy.concatenate([w.ravel() for w in model.get_weights()]).astype('float32')
+        
+        flat = npcnn.cached(path, '_keras_' + backend_name, build)
+        if flat.size != sum(int(numpy.prod(shape)) for shape in shapes):
+            model.load_weights(path)
+            return
+        weights = []
+        offset = 0
+        for shape in shapes:
+            size = int(numpy.prod(shape))
+            weights.append(flat[offset:offset+size].reshape(shape))
+            offset += size
+        model.set_weights(weights)
+        
+        return
+    
+    # ~~~~~~~~ get model of engine loading it if needed ~~~~~~~~
+    def _model(self, engine='EN'):
+        engine = engine.upper()
+        model = self._models.get(engine)
+        if model is None:
+            with self._load_lock:
+                model = self._models.get(engine)
+                if model is None:
+                    t_start = time.perf_counter()
+                    m_start = _resident_memory()
+                    if self._backend == 'numpy' and self._cache:
+                        model = npcnn.load(self._paths[engine], self._quantize, dequantize=not self._shared_weights)
+                    elif self._backend == 'numpy':
+                        model = npcnn.NumpyCNN(npcnn.pack(npcnn.read_h5(self._paths[engine]), self._quantize))
+                    else:
+                        model = self._cnn(self._i_shape, self._n_class, self._paths[engine])
+                    # build predict function before the model is shared across threads
+                    if hasattr(model, '_make_predict_function'):
+                        model._make_predict_function()
+                    self._load_times[engine] = time.perf_counter() - t_start
+                    self._load_memory[engine] = _resident_memory() - m_start
+                    self._models[engine] = model
         
         return model
     
+    # ~~~~~~~~ check if model of engine is loaded ~~~~~~~~
+    def is_ready(self, engine='EN'):
+        return engine.upper() in self._models
+    
+    # ~~~~~~~~ load models on background thread ~~~~~~~~
+    def preload(self, engines=None):
+        if engines is None:
+            engines = sorted(self._paths)
+        with self._preload_lock:
+            # requested engines move to the front of the queue
+            for engine in reversed([engine.upper() for engine in engines]):
+                if engine in self._models:
+                    continue
+                if engine in self._preload_queue:
+                    self._preload_queue.remove(engine)
+                self._preload_queue.insert(0, engine)
+            if len(self._preload_queue) > 0 and self._preloader is None:
+                self._preloader = threading.Thread(target=self._preload, daemon=True)
+                self._preloader.start()
+        
+        return
+    
+    # ~~~~~~~~ background loading loop ~~~~~~~~
+    def _preload(self):
+        try:
+            while True:
+                with self._preload_lock:
+                    if len(self._preload_queue) == 0:
+                        self._preloader = None
+                        break
+                    engine = self._preload_queue.pop(0)
+                self._model(engine)
+        except Exception:
+            with self._preload_lock:
+                self._preloader = None
+            raise
+        
+        return
+    
+    # ~~~~~~~~ model load times ~~~~~~~~
+    def get_load_times(self):
+        return dict(self._load_times)
+    
+    # ~~~~~~~~ resident memory added by model loads in megabytes ~~~~~~~~
+    def get_load_memory(self):
+        return dict(self._load_memory)
+    
     # ~~~~~~~~ resize image ~~~~~~~~
     def _resize(self, image):
         w = image.shape[1]
@@ -112,73 +296,261 @@ class Recognizer(object):
         
         return image
     
+    # ~~~~~~~~ set instrumentation ~~~~~~~~
+    def set_instrumentation(self, instrumentation):
+        self._instruments = instrumentation
+        
+        return
+    
     # ~~~~~~~~ predict ~~~~~~~~
     def predict(self, image, engine='EN', mapping=True):
+        t_start = self._instruments.tick()
+        
+        # preprocess every glyph into one batch
+        batch = self._extract_glyphs(image)
+        
+        # predict all glyphs with a single model call
+        predictions = self._classify(batch, engine, mapping)
+        self._instruments.tock('predict', t_start)
+        
+        return predictions
+    
+    # ~~~~~~~~ extract glyphs ~~~~~~~~
+    def _extract_glyphs(self, image):
         # find contours in image
-        if self._opencv_version == 2:
-            contours = cv2.findContours(image.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[0]
-        else:
+        # -- contours are the first return value in opencv 2 and 4 --
+        if self._opencv_version == 3:
             contours = cv2.findContours(image.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[1]
+        else:
+            contours = cv2.findContours(image.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)[0]
         
-        # find bounding rectangle around each contour
-        bn_rects = []
-        
-        for cntr in contours:
-            bn_rects.append(cv2.boundingRect(cntr))
+        # find bounding rectangle around each contour ignoring tiny objects assuming them as noise
+        bn_rects = [cv2.boundingRect(cntr) for cntr in contours]
+        bn_rects = [rect for rect in bn_rects if rect[3] >= self._min_size]
         
         # sort bounding rectangles from left to right
         bn_rects.sort(key=lambda x: x[0])
         
+        # grow preallocated batch if needed
+        n = len(bn_rects)
+        if self._batch.shape[0] < n:
+            self._batch = numpy.zeros((n,) + self._i_shape, dtype='float32')
+        batch = self._batch[:n]
+        
         # process each bounding rectangle
-        prediction = []
-        predprobas = []
-        
-        for rect in bn_rects:
-            # attributes of bounding rectangle
-            x = rect[0]
-            y = rect[1]
-            w = rect[2]
-            h = rect[3]
-            
-            # ignore tiny objects assuming them as noise
-            if h < self._min_size:
-                continue
-            
-            # extract region of interest
-            image = image[y:y+h, x:x+w]
+        for i, (x, y, w, h) in enumerate(bn_rects):
+            # extract region of interest from original image
+            glyph = image[y:y+h, x:x+w]
             
             # resize region of interest
-            image = self._resize(image)
+            glyph = self._resize(glyph)
             
             # perform dilation
-            image = cv2.dilate(image, self._d_kernel)
+            glyph = cv2.dilate(glyph, self._d_kernel)
             
-            # reshape and scale features
-            image = image.astype('float64').reshape(1, 1, self._i_shape[2], self._i_shape[1]) / 255.0
-            
-            # predict label
-            if engine.upper() == 'EN':
-                prob = self._model_en.predict(image)
-            elif engine.upper() == 'BN':
-                prob = self._model_bn.predict(image)
-            elif engine.upper() == 'DV':
-                prob = self._model_dv.predict(image)
-            
-            # map label
-            if mapping and engine.upper() == 'EN':
-                pred = chr(mapper.map2ascii_en_numbers[numpy.argmax(prob)])
-            elif mapping and engine.upper() == 'BN':
-                pred = mapper.map2unicode_bn_numbers[numpy.argmax(prob)]
-            elif mapping and engine.upper() == 'DV':
-                pred = mapper.map2unicode_dv_numbers[numpy.argmax(prob)]
-            else:
-                pred = numpy.argmax(prob)
-            
-            # estimate confidence
-            prob = numpy.round(numpy.max(prob), 4)
-            
-            # append result to list
-            prediction.append(str(pred))
-            predprobas.append(str(prob))
+            # scale features into batch
+            numpy.multiply(glyph, 1.0 / 255.0, out=batch[i, 0], casting='unsafe')
+        
+        return batch
+    
+    # ~~~~~~~~ set prediction cache ~~~~~~~~
+    def set_prediction_cache(self, size=1024, grid=56, levels=256, audit_every=0):
+        # class probabilities are cached per engine and normalized glyph
+        # -- glyphs are keyed by a hash after downsampling to grid x grid and quantizing to levels --
+        # -- grid 56 and levels 256 hit exact duplicates only, coarser keys hit near-duplicates --
+        # -- every n-th hit is audited against the model to measure mismatches of near-duplicates --
+        # -- least recently used entries are evicted beyond size, size 0 disables the cache --
+        if grid < 1 or grid > self._i_shape[1] or levels < 2 or levels > 256:
+            raise ValueError('invalid cache key resolution: grid {} levels {}'.format(grid, levels))
+        with self._cache_lock:
+            self._cache_size = size
+            self._cache_grid = grid
+            self._cache_levels = levels
+            self._cache_audit_every = audit_every
+            self._cache_entries.clear()
+        
+        return
+    
+    # ~~~~~~~~ clear prediction cache and statistics ~~~~~~~~
+    def clear_prediction_cache(self):
+        with self._cache_lock:
+            self._cache_entries.clear()
+            self._cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'audits': 0, 'mismatches': 0}
+        
+        return
+    
+    # ~~~~~~~~ prediction cache statistics ~~~~~~~~
+    def get_cache_stats(self):
+        with self._cache_lock:
+            stats = dict(self._cache_stats)
+            stats['size'] = len(self._cache_entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups > 0 else 0.0
+        
+        return stats
+    
+    # ~~~~~~~~ cache key of normalized glyph ~~~~~~~~
+    def _cache_key(self, engine, glyph):
+        if self._cache_grid != glyph.shape[0]:
+            glyph = cv2.resize(glyph, (self._cache_grid, self._cache_grid), interpolation=cv2.INTER_AREA)
+        glyph = numpy.rint(glyph * (self._cache_levels - 1)).astype('uint8')
         
-        return [prediction, predprobas]
+        return (engine.upper(), hashlib.blake2b(glyph.tobytes(), digest_size=16).digest())
+    
+    # ~~~~~~~~ class probabilities with prediction cache ~~~~~~~~
+    def _predict_proba(self, features, engine='EN'):
+        if self._cache_size <= 0:
+            return self._model(engine).predict(features)
+        
+        # look up every glyph and audit some hits
+        keys = [self._cache_key(engine, features[i, 0]) for i in range(features.shape[0])]
+        prob = [None] * len(keys)
+        audits = []
+        with self._cache_lock:
+            for i, key in enumerate(keys):
+                cached = self._cache_entries.get(key)
+                if cached is None:
+                    self._cache_stats['misses'] += 1
+                    continue
+                self._cache_entries.move_to_end(key)
+                self._cache_stats['hits'] += 1
+                prob[i] = cached
+                if self._cache_audit_every > 0 and self._cache_stats['hits'] % self._cache_audit_every == 0:
+                    audits.append(i)
+        
+        # predict misses and audited hits in one model call
+        missing = [i for i in range(len(keys)) if prob[i] is None or i in audits]
+        self._instruments.count('cache_hits', len(keys) - len(missing) + len(audits))
+        self._instruments.count('cache_misses', len(missing) - len(audits))
+        if len(missing) > 0:
+            predicted = self._model(engine).predict(features[missing])
+            with self._cache_lock:
+                for j, i in enumerate(missing):
+                    if not prob[i] is None:
+                        self._cache_stats['audits'] += 1
+                        if numpy.argmax(prob[i]) != numpy.argmax(predicted[j]):
+                            self._cache_stats['mismatches'] += 1
+                        continue
+                    prob[i] = predicted[j].copy()
+                    self._cache_entries[keys[i]] = prob[i]
+                    if len(self._cache_entries) > self._cache_size:
+                        self._cache_entries.popitem(last=False)
+                        self._cache_stats['evictions'] += 1
+        
+        return numpy.array(prob)
+    
+    # ~~~~~~~~ classify batch of features ~~~~~~~~
+    def _classify(self, features, engine='EN', mapping=True):
+        if features.shape[0] == 0:
+            return [numpy.array([], dtype='str'), numpy.array([], dtype='float32')]
+        
+        # predict labels
+        prob = self._predict_proba(features, engine)
+        labels = numpy.argmax(prob, axis=1)
+        
+        # map labels
+        if mapping and engine.upper() == 'EN':
+            pred = [chr(mapper.map2ascii_en_numbers[label]) for label in labels]
+        elif mapping and engine.upper() == 'BN':
+            pred = [mapper.map2unicode_bn_numbers[label] for label in labels]
+        elif mapping and engine.upper() == 'DV':
+            pred = [mapper.map2unicode_dv_numbers[label] for label in labels]
+        else:
+            pred = [str(label) for label in labels]
+        
+        # estimate confidences
+        prob = numpy.round(numpy.max(prob, axis=1), 4).astype('float32')
+        
+        return [numpy.array(pred, dtype='str'), prob]
+    
+    
+    # ~~~~~~~~ rasterize stroke points into glyph ~~~~~~~~
+    def _rasterize(self, points, thickness=4):
+        points = numpy.asarray(points, dtype='float64').reshape(-1, 2)
+        dst_w = self._i_shape[1]
+        dst_h = self._i_shape[2]
+        box_w = self._b_shape[1]
+        box_h = self._b_shape[2]
+        
+        # extent of stroke including line thickness and antialiasing
+        r = thickness // 2 + 1
+        p_min = points.min(axis=0) - r
+        w = int(points[:, 0].max() - points[:, 0].min()) + 2 * r + 1
+        h = int(points[:, 1].max() - points[:, 1].min()) + 2 * r + 1
+        
+        # scale into box and centre in glyph as the raster path does
+        if w >= h:
+            scale = box_w / w
+            new_w = box_w
+            new_h = h * box_w // w
+        else:
+            scale = box_h / h
+            new_w = w * box_h // h
+            new_h = box_h
+        pad_w = (dst_w - new_w) // 2
+        pad_h = (dst_h - new_h) // 2
+        
+        # draw thin lines with intensity of area averaged thick lines
+        # -- widths are rounded down below 0.7 past a whole pixel as antialiasing widens lines --
+        points = (points - p_min + 0.5) * scale + (pad_w - 0.5, pad_h - 0.5)
+        points = numpy.int32(numpy.round(points * (1 << self._glyph_shift))).reshape(-1, 1, 2)
+        width = max(1, int(thickness * scale + 0.3))
+        color = 255 * min(1.0, thickness * scale)
+        self._glyph.fill(0)
+        cv2.polylines(self._glyph, [points], False, (color, color, color), width, cv2.LINE_AA, self._glyph_shift)
+        
+        return self._glyph
+    
+    # ~~~~~~~~ prepare features from stroke points ~~~~~~~~
+    def prepare_points(self, points, thickness=4):
+        # ignore tiny strokes assuming them as noise
+        if len(points) < 2 or numpy.ptp(numpy.asarray(points)[:, 1]) + 2 * (thickness // 2 + 1) + 1 < self._min_size:
+            return self._glyph_input[:0]
+        
+        # rasterize points straight into glyph
+        glyph = self._rasterize(points, thickness)
+        
+        # perform dilation
+        glyph = cv2.dilate(glyph, self._d_kernel)
+        
+        # scale features into reused input tensor
+        numpy.multiply(glyph, 1.0 / 255.0, out=self._glyph_input[0, 0], casting='unsafe')
+        
+        return self._glyph_input
+    
+    # ~~~~~~~~ predict from stroke points ~~~~~~~~
+    def predict_points(self, points, engine='EN', mapping=True, thickness=4):
+        t_start = self._instruments.tick()
+        predictions = self._classify(self.prepare_points(points, thickness), engine, mapping)
+        self._instruments.tock('predict', t_start)
+        
+        return predictions
+
+
+# main
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure startup time and resident memory per engine.')
+    parser.add_argument('engines', nargs='*', default=['EN', 'BN', 'DV'])
+    parser.add_argument('--backend', default='keras', choices=['keras', 'numpy'])
+    parser.add_argument('--int8', action='store_true', help='use int8 quantized weights')
+    parser.add_argument('--compile', action='store_true', help='compile models with optimizer state')
+    parser.add_argument('--no-cache', action='store_true', help='load weights from source models')
+    parser.add_argument('--shared', action='store_true', help='keep weights as shared memory-mapped views')
+    args = parser.parse_args()
+    
+    m_start = _resident_memory()
+    t_start = time.perf_counter()
+    recognizer = Recognizer(engines=args.engines, backend=args.backend, quantize=args.int8,
+                            inference_only=not args.compile, cache=not args.no_cache,
+                            shared_weights=args.shared)
+    t_loaded = time.perf_counter()
+    for engine in args.engines:
+        recognizer._classify(numpy.zeros((1,) + recognizer._i_shape, dtype='float32'), engine)
+    t_predicted = time.perf_counter()
+    
+    times = recognizer.get_load_times()
+    memory = recognizer.get_load_memory()
+    for engine in args.engines:
+        print('[INFO] {} loaded in {:.3f}s using {:.1f}MB'.format(engine, times[engine], memory[engine]))
+    print('[INFO] startup {:.3f}s, first predictions {:.3f}s, resident memory {:.1f}MB (+{:.1f}MB)'.format(
+        t_loaded - t_start, t_predicted - t_loaded, _resident_memory(), _resident_memory() - m_start))
@@ -0,0 +1,423 @@
+# -*- coding: utf-8 -*-
+"""
+Compact recording and replay of air-writing sessions.
+Created on Fri May 25 20:00:00 2018
+Author: Prasun Roy | CVPRU-ISICAL (http://www.isical.ac.in/~cvpr)
+GitHub: https://github.com/prasunroy/air-writing
+
+"""
+
+
+# imports
+from __future__ import division
+
+import argparse
+import io
+import itertools
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+import cv2
+import numpy
+
+from pipeline import Pipeline
+from recognizer import Recognizer
+
+
+# file layout
+# -- header: magic, uint32 metadata length, JSON metadata padded to 8 bytes --
+# -- chunks: 4 byte tag, uint32 rows, uint64 payload bytes, payload padded to 8 bytes --
+# -- track payload holds one column after another, each padded to 8 bytes --
+# -- event payload holds JSON lines of recognition events --
+# -- a truncated last chunk of an interrupted recording is ignored --
+MAGIC = b'AWSESS01'
+TAG_TRACK = b'TRCK'
+TAG_EVENT = b'EVNT'
+CHUNK_HEADER = struct.Struct('<4sIQ')
+
+# columns of track chunks with one row per frame
+# -- x and y are -1 when no marker was found --
+TRACK_COLUMNS = (
+    ('frame', 'int64'),
+    ('timestamp', 'float64'),
+    ('x', 'int32'),
+    ('y', 'int32'),
+    ('tip_x', 'float32'),
+    ('tip_y', 'float32'),
+    ('area', 'int32'),
+    ('box_x', 'int32'),
+    ('box_y', 'int32'),
+    ('box_w', 'int32'),
+    ('box_h', 'int32')
+)
+
+
+# ~~~~~~~~ padding to 8 byte alignment ~~~~~~~~
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+# SessionRecorder class
+class SessionRecorder(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, path, chunk_size=1024, metadata=None):
+        # rows are buffered in preallocated columns and written one chunk at a time
+        self.path = path
+        self.started = False
+        self.frames = 0
+        self._file = None
+        self._metadata = dict(metadata) if not metadata is None else {}
+        self._chunk_size = chunk_size
+        self._columns = {name: numpy.zeros(chunk_size, dtype=dtype) for name, dtype in TRACK_COLUMNS}
+        self._rows = 0
+        self._events = []
+        
+        # events arrive from the recognition executor
+        self._lock = threading.Lock()
+        
+        return
+    
+    # ~~~~~~~~ write header with stroke settings and frame size ~~~~~~~~
+    def start(self, settings, shape):
+        metadata = dict(self._metadata)
+        metadata.update({
+            'version': 1,
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'width': int(shape[1]),
+            'height': int(shape[0]),
+            'settings': settings,
+            'columns': [list(column) for column in TRACK_COLUMNS]
+        })
+        header = json.dumps(metadata).encode('utf-8')
+        self._file = open(self.path, 'wb')
+        self._file.write(MAGIC + struct.pack('<I', len(header)) + header + b'\0' * _pad(len(MAGIC) + 4 + len(header)))
+        self.started = True
+        
+        return
+    
+    # ~~~~~~~~ append marker tip and blob of frame ~~~~~~~~
+    def append(self, timestamp, marker_tip, blob=None):
+        i = self._rows
+        columns = self._columns
+        columns['frame'][i] = self.frames
+        columns['timestamp'][i] = timestamp
+        if marker_tip is None:
+            columns['x'][i] = -1
+            columns['y'][i] = -1
+        else:
+            columns['x'][i] = marker_tip[0]
+            columns['y'][i] = marker_tip[1]
+        if blob is None:
+            columns['tip_x'][i] = -1.0
+            columns['tip_y'][i] = -1.0
+            columns['area'][i] = 0
+            columns['box_x'][i] = columns['box_y'][i] = columns['box_w'][i] = columns['box_h'][i] = 0
+        else:
+            columns['tip_x'][i], columns['tip_y'][i] = blob['tip']
+            columns['area'][i] = blob['area']
+            columns['box_x'][i], columns['box_y'][i], columns['box_w'][i], columns['box_h'][i] = blob['box']
+        self._rows += 1
+        self.frames += 1
+        if self._rows == self._chunk_size:
+            self.flush()
+        
+        return
+    
+    # ~~~~~~~~ append recognition event ~~~~~~~~
+    def append_event(self, event):
+        record = {
+            'stroke': event['stroke'],
+            'engine': event['engine'],
+            'timestamp': event['timestamp'],
+            'prediction': None if event['prediction'] is None else [str(p) for p in event['prediction']],
+            'confidence': None if event['confidence'] is None else [round(float(p), 4) for p in event['confidence']],
+            'latency': round(event['latency'], 6)
+        }
+        for key in ('glyph', 'final', 'text'):
+            if key in event:
+                record[key] = event[key]
+        if 'error' in event:
+            record['error'] = str(event['error'])
+        with self._lock:
+            self._events.append(record)
+        
+        return
+    
+    # ~~~~~~~~ write chunk ~~~~~~~~
+    def _write_chunk(self, tag, rows, parts):
+        payload = b''.join(parts)
+        self._file.write(CHUNK_HEADER.pack(tag, rows, len(payload)) + payload)
+        
+        return
+    
+    # ~~~~~~~~ write buffered rows and events ~~~~~~~~
+    def flush(self):
+        if not self.started:
+            return
+        if self._rows > 0:
+            parts = []
+            for name, dtype in TRACK_COLUMNS:
+                data = self._columns[name][:self._rows].tobytes()
+                parts += [data, b'\0' * _pad(len(data))]
+            self._write_chunk(TAG_TRACK, self._rows, parts)
+            self._rows = 0
+        with self._lock:
+            events = self._events
+            self._events = []
+        if len(events) > 0:
+            data = ''.join(json.dumps(event) + '\n' for event in events).encode('utf-8')
+            self._write_chunk(TAG_EVENT, len(events), [data, b' ' * _pad(len(data))])
+        self._file.flush()
+        
+        return
+    
+    # ~~~~~~~~ write remaining rows and close file ~~~~~~~~
+    def close(self):
+        if self.started and not self._file.closed:
+            self.flush()
+            self._file.close()
+        
+        return
+
+
+# SessionReader class
+class SessionReader(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, path):
+        # columns are views into the memory-mapped file without copies
+        self.path = path
+        self._data = numpy.memmap(path, dtype='uint8', mode='r') if os.path.getsize(path) > 0 else numpy.zeros(0, 'uint8')
+        if self._data[:len(MAGIC)].tobytes() != MAGIC:
+            raise IOError('not a session recording: {}'.format(path))
+        n = struct.unpack('<I', self._data[len(MAGIC):len(MAGIC) + 4].tobytes())[0]
+        self.metadata = json.loads(self._data[len(MAGIC) + 4:len(MAGIC) + 4 + n].tobytes().decode('utf-8'))
+        self.settings = self.metadata['settings']
+        self.shape = (self.metadata['height'], self.metadata['width'])
+        columns = [tuple(column) for column in self.metadata['columns']]
+        
+        # index chunks up to the last complete one
+        self._track_chunks = []
+        self._event_chunks = []
+        offset = len(MAGIC) + 4 + n + _pad(len(MAGIC) + 4 + n)
+        while offset + CHUNK_HEADER.size <= self._data.shape[0]:
+            tag, rows, size = CHUNK_HEADER.unpack(self._data[offset:offset + CHUNK_HEADER.size].tobytes())
+            offset += CHUNK_HEADER.size
+            if offset + size > self._data.shape[0]:
+                break
+            if tag == TAG_TRACK:
+                chunk = {}
+                position = offset
+                for name, dtype in columns:
+                    chunk[name] = numpy.frombuffer(self._data, dtype=dtype, count=rows, offset=position)
+                    position += rows * numpy.dtype(dtype).itemsize
+                    position += _pad(rows * numpy.dtype(dtype).itemsize)
+                self._track_chunks.append(chunk)
+            elif tag == TAG_EVENT:
+                self._event_chunks.append((offset, size))
+            offset += size
+        
+        return
+    
+    # ~~~~~~~~ number of recorded frames ~~~~~~~~
+    def __len__(self):
+        return sum(chunk['frame'].shape[0] for chunk in self._track_chunks)
+    
+    # ~~~~~~~~ track columns of each chunk ~~~~~~~~
+    def chunks(self):
+        return list(self._track_chunks)
+    
+    # ~~~~~~~~ track columns of whole session ~~~~~~~~
+    def track(self, columns=None):
+        names = [name for name, dtype in TRACK_COLUMNS] if columns is None else columns
+        if len(self._track_chunks) == 1:
+            return {name: self._track_chunks[0][name] for name in names}
+        
+        return {name: numpy.concatenate([chunk[name] for chunk in self._track_chunks]) if len(self._track_chunks) > 0
+                else numpy.zeros(0, dtype=dict(TRACK_COLUMNS)[name]) for name in names}
+    
+    # ~~~~~~~~ recorded recognition events ~~~~~~~~
+    def events(self):
+        events = []
+        for offset, size in self._event_chunks:
+            for line in self._data[offset:offset + size].tobytes().decode('utf-8').splitlines():
+                if line.strip():
+                    events.append(json.loads(line))
+        events.sort(key=lambda event: event['stroke'])
+        
+        return events
+
+
+# ~~~~~~~~ replay session through trajectory approximation and recognition ~~~~~~~~
+def replay(path, recognizer, settings=None, engine=None, mapping=True):
+    reader = SessionReader(path)
+    recorded = reader.events()
+    if engine is None:
+        engine = recorded[0]['engine'] if len(recorded) > 0 else 'EN'
+    
+    # recorded settings apply unless overridden
+    pipeline = Pipeline(recognizer=recognizer)
+    pipeline.set_stroke_settings(reader.settings)
+    if not settings is None:
+        pipeline.set_stroke_settings(settings)
+    
+    # columns are converted to lists once as indexing numpy scalars per frame is slow
+    # -- events are collected per chunk as the pipeline keeps a bounded number --
+    replayed = []
+    t_start = time.perf_counter()
+    for chunk in reader.chunks():
+        for timestamp, x, y in zip(chunk['timestamp'].tolist(), chunk['x'].tolist(), chunk['y'].tolist()):
+            pipeline.run_tracking(None if x < 0 else (x, y), reader.shape, engine, mapping, timestamp)
+        replayed += pipeline.get_events()
+    t_total = time.perf_counter() - t_start
+    
+    events = [{
+        'stroke': event['stroke'],
+        'timestamp': event['timestamp'],
+        'prediction': None if event['prediction'] is None else [str(p) for p in event['prediction']],
+        'confidence': None if event['confidence'] is None else [round(float(p), 4) for p in event['confidence']]
+    } for event in replayed]
+    text = ''.join(''.join(event['prediction']) for event in events if not event['prediction'] is None)
+    recorded_text = ''.join(''.join(event['prediction']) for event in recorded if not event['prediction'] is None)
+    result = {
+        'source': path,
+        'settings': pipeline.get_stroke_settings(),
+        'frames': len(reader),
+        'strokes': len(events),
+        'text': text,
+        'recorded_text': recorded_text,
+        'matches_recorded': text == recorded_text,
+        'seconds': round(t_total, 4),
+        'events': events
+    }
+    
+    return result
+
+
+# worker process state
+_worker_args = None
+_worker_recognizer = None
+
+
+# ~~~~~~~~ initialize worker process ~~~~~~~~
+def _init_worker(args):
+    global _worker_args, _worker_recognizer
+    
+    # one thread per process as parallelism comes from the pool
+    cv2.setNumThreads(1)
+    _worker_args = args
+    _worker_recognizer = Recognizer(engines=(), backend=args.backend, quantize=args.int8,
+                                    shared_weights=args.backend == 'numpy')
+    
+    return
+
+
+# ~~~~~~~~ replay task in worker process ~~~~~~~~
+def _run_task(task):
+    path, settings = task
+    
+    # a failing setting or session is reported and the other replays go on
+    try:
+        result = replay(path, _worker_recognizer, settings, _worker_args.engine)
+    except Exception as e:
+        return {'source': path, 'settings': settings, 'error': '{}: {}'.format(type(e).__name__, e)}
+    if not _worker_args.events:
+        del result['events']
+    
+    return result
+
+
+# ~~~~~~~~ grid of stroke settings ~~~~~~~~
+def settings_grid(args):
+    axes = [(name, values) for name, values in (('min_change', args.min_change), ('min_veloxy', args.min_veloxy),
+                                                ('max_points', args.max_points)) if not values is None]
+    
+    return [dict(zip([name for name, values in axes], combination))
+            for combination in itertools.product(*[values for name, values in axes])]
+
+
+# ~~~~~~~~ command line arguments ~~~~~~~~
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect and replay recorded air-writing sessions.')
+    parser.add_argument('command', choices=['info', 'replay'])
+    parser.add_argument('inputs', nargs='+', help='session recordings')
+    parser.add_argument('-o', '--output', default='-', help='JSONL output file (default stdout)')
+    parser.add_argument('--engine', default=None, choices=['EN', 'BN', 'DV'],
+                        help='recognition engine (default engine of recorded events)')
+    parser.add_argument('--backend', default='numpy', choices=['keras', 'numpy'], help='inference backend')
+    parser.add_argument('--int8', action='store_true', help='use int8 quantized weights')
+    parser.add_argument('--min-change', type=int, nargs='+', default=None, help='values to replay with')
+    parser.add_argument('--min-veloxy', type=float, nargs='+', default=None, help='values to replay with')
+    parser.add_argument('--max-points', type=int, nargs='+', default=None, help='values to replay with')
+    parser.add_argument('--events', action='store_true', help='include every replayed event in output')
+    parser.add_argument('--workers', type=int, default=0, help='replay on a pool of worker processes')
+    
+    return parser.parse_args(argv)
+
+
+# main
+if __name__ == '__main__':
+    args = parse_args()
+    if args.output == '-':
+        output = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8', line_buffering=True)
+    else:
+        output = io.open(args.output, 'w', encoding='utf-8')
+    
+    if args.command == 'info':
+        for path in args.inputs:
+            reader = SessionReader(path)
+            track = reader.track(['timestamp', 'x'])
+            info = {
+                'source': path,
+                'bytes': os.path.getsize(path),
+                'frames': len(reader),
+                'chunks': len(reader.chunks()),
+                'seconds': round(float(track['timestamp'][-1] - track['timestamp'][0]), 3) if len(reader) > 0 else 0.0,
+                'marker_frames': int(numpy.count_nonzero(track['x'] >= 0)),
+                'events': len(reader.events()),
+                'width': reader.metadata['width'],
+                'height': reader.metadata['height'],
+                'settings': reader.settings
+            }
+            output.write(json.dumps(info) + '\n')
+        sys.exit(0)
+    
+    # every session is replayed with every combination of given settings
+    tasks = [(path, settings) for path in args.inputs for settings in settings_grid(args)]
+    t_start = time.perf_counter()
+    failed = 0
+    if args.workers > 0:
+        import multiprocessing
+        
+        # convert weights once so that workers map the same cache
+        if args.backend == 'numpy':
+            Recognizer(engines=('EN', 'BN', 'DV'), backend='numpy', quantize=args.int8)
+        for name in ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS'):
+            os.environ.setdefault(name, '1')
+        pool = multiprocessing.get_context('spawn').Pool(args.workers, _init_worker, (args,))
+        try:
+            for result in pool.imap(_run_task, tasks, chunksize=4):
+                failed += int('error' in result)
+                output.write(json.dumps(result, ensure_ascii=False) + '\n')
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        _init_worker(args)
+        for task in tasks:
+            result = _run_task(task)
+            failed += int('error' in result)
+            output.write(json.dumps(result, ensure_ascii=False) + '\n')
+    t_total = time.perf_counter() - t_start
+    sys.stderr.write('[INFO] {} replays in {:.2f}s, {:.0f} per minute\n'.format(
+        len(tasks), t_total, len(tasks) * 60.0 / t_total if t_total > 0 else 0.0))
+    
+    if args.output != '-':
+        output.close()
+    if failed > 0:
+        sys.exit('[ERROR] {} of {} replays failed'.format(failed, len(tasks)))
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+"""
+Predictive marker tracking.
+Created on Sat May 19 20:00:00 2018
+Author: Prasun Roy | CVPRU-ISICAL (http://www.isical.ac.in/~cvpr)
+GitHub: https://github.com/prasunroy/air-writing
+
+"""
+
+
+# imports
+import cv2
+import numpy
+
+
+# KalmanTracker class
+class KalmanTracker(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, process_noise=1.0, measurement_noise=4.0, max_misses=5, max_jump=32.0):
+        # constant velocity model with state (x, y, vx, vy) and measurement (x, y)
+        self._kf = cv2.KalmanFilter(4, 2)
+        self._transition = numpy.array([[1, 0, 1, 0],
+                                        [0, 1, 0, 1],
+                                        [0, 0, 1, 0],
+                                        [0, 0, 0, 1]], dtype='float32')
+        self._kf.transitionMatrix = self._transition
+        self._kf.measurementMatrix = numpy.array([[1, 0, 0, 0],
+                                                  [0, 1, 0, 0]], dtype='float32')
+        self._kf.processNoiseCov = numpy.eye(4, dtype='float32') * process_noise
+        self._kf.measurementNoiseCov = numpy.eye(2, dtype='float32') * measurement_noise
+        
+        # track properties
+        # -- a marker found farther than max_jump from a carried track starts a new track --
+        self._max_misses = max_misses
+        self._max_jump = max_jump
+        self._active = False
+        self._misses = 0
+        self._predicted = None
+        self._measured = 0
+        self._start = None
+        self._elapsed = 0.0
+        self.restarted = False
+        
+        return
+    
+    # ~~~~~~~~ reset track ~~~~~~~~
+    def reset(self):
+        self._active = False
+        self._misses = 0
+        self._predicted = None
+        self._measured = 0
+        
+        return
+    
+    # ~~~~~~~~ track status ~~~~~~~~
+    def is_active(self):
+        return self._active
+    
+    # ~~~~~~~~ predict position in next frame ~~~~~~~~
+    def predict(self, dt=1.0):
+        if not self._active:
+            return None
+        self._transition[0, 2] = dt
+        self._transition[1, 3] = dt
+        self._kf.transitionMatrix = self._transition
+        state = self._kf.predict()
+        self._elapsed += dt
+        self._predicted = (int(round(float(state[0, 0]))), int(round(float(state[1, 0]))))
+        
+        return self._predicted
+    
+    # ~~~~~~~~ correct track with measured position ~~~~~~~~
+    def correct(self, marker_tip):
+        measurement = numpy.array([[marker_tip[0]], [marker_tip[1]]], dtype='float32')
+        self.restarted = False
+        if self._active and self._misses > 0 and max(abs(marker_tip[0] - self._predicted[0]),
+                                                     abs(marker_tip[1] - self._predicted[1])) > self._max_jump:
+            self.reset()
+            self.restarted = True
+        if not self._active:
+            # start track at measured position with zero velocity
+            self._kf.statePost = numpy.array([[marker_tip[0]], [marker_tip[1]], [0], [0]], dtype='float32')
+            self._kf.errorCovPost = numpy.eye(4, dtype='float32') * 10.0
+            self._active = True
+            self._misses = 0
+            self._measured = 1
+            self._start = (marker_tip[0], marker_tip[1])
+            self._elapsed = 0.0
+            return (int(marker_tip[0]), int(marker_tip[1]))
+        if self._measured == 1:
+            # take velocity from the first two measurements instead of smoothing towards rest
+            steps = max(self._elapsed, 1.0)
+            self._kf.statePost = numpy.array([[marker_tip[0]], [marker_tip[1]],
+                                              [(marker_tip[0] - self._start[0]) / steps],
+                                              [(marker_tip[1] - self._start[1]) / steps]], dtype='float32')
+            self._misses = 0
+            self._measured = 2
+            return (int(marker_tip[0]), int(marker_tip[1]))
+        state = self._kf.correct(measurement)
+        self._misses = 0
+        
+        return (int(round(float(state[0, 0]))), int(round(float(state[1, 0]))))
+    
+    # ~~~~~~~~ carry track through missed detection ~~~~~~~~
+    def miss(self):
+        if not self._active:
+            return None
+        self._misses += 1
+        if self._misses > self._max_misses:
+            self.reset()
+            return None
+        
+        return self._predicted
@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+"""
+Marker trajectory state.
+Created on Sun May 20 20:00:00 2018
+Author: Prasun Roy | CVPRU-ISICAL (http://www.isical.ac.in/~cvpr)
+GitHub: https://github.com/prasunroy/air-writing
+
+"""
+
+
+# imports
+from __future__ import division
+
+import cv2
+import numpy
+
+
+# Trajectory class
+class Trajectory(object):
+    
+    __slots__ = ('x', 'y', 'dx', 'dy', 'vx', 'vy', 'interval', 'window',
+                 '_hist_t', '_hist_dx', '_hist_dy', '_hist_head', '_hist_size', '_sum_dx', '_sum_dy',
+                 '_points', '_point_head', '_point_size', '_timestamp')
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, window=1.0, history=256, max_points=50):
+        # velocity is measured over a time window in seconds
+        self.window = window
+        
+        # displacement history ring buffer with running sums
+        self._hist_t = numpy.zeros(history, dtype='float64')
+        self._hist_dx = numpy.zeros(history, dtype='float64')
+        self._hist_dy = numpy.zeros(history, dtype='float64')
+        
+        # trajectory points ring buffer
+        self._points = numpy.zeros((max_points + 1, 2), dtype='int32')
+        
+        self.reset()
+        
+        return
+    
+    # ~~~~~~~~ reset trajectory ~~~~~~~~
+    def reset(self):
+        self.x = -1
+        self.y = -1
+        self.dx = 0
+        self.dy = 0
+        self.vx = 0.0
+        self.vy = 0.0
+        self.interval = 0.0
+        self._hist_head = 0
+        self._hist_size = 0
+        self._sum_dx = 0.0
+        self._sum_dy = 0.0
+        self._point_head = 0
+        self._point_size = 0
+        self._timestamp = None
+        
+        return
+    
+    # ~~~~~~~~ number of trajectory points ~~~~~~~~
+    def __len__(self):
+        return self._point_size
+    
+    # ~~~~~~~~ trajectory points in order ~~~~~~~~
+    def points(self):
+        n = self._points.shape[0]
+        return [(int(self._points[(self._point_head + i) % n, 0]), int(self._points[(self._point_head + i) % n, 1]))
+                for i in range(self._point_size)]
+    
+    # ~~~~~~~~ latest trajectory point ~~~~~~~~
+    def last(self, k=1):
+        n = self._points.shape[0]
+        i = (self._point_head + self._point_size - k) % n
+        
+        return (int(self._points[i, 0]), int(self._points[i, 1]))
+    
+    # ~~~~~~~~ update trajectory with marker tip ~~~~~~~~
+    def update(self, marker_tip, timestamp, min_change=10, max_points=50):
+        # grow points buffer if limit changed
+        # -- points are unrolled to the start of the new buffer, empty trajectories included --
+        if self._points.shape[0] < max_points + 1:
+            points = numpy.asarray(self.points(), dtype='int32').reshape(-1, 2)
+            self._points = numpy.zeros((max_points + 1, 2), dtype='int32')
+            self._points[:len(points)] = points
+            self._point_head = 0
+            self._point_size = len(points)
+        
+        # update position of marker
+        if self.x < 0 or self.y < 0:
+            self.x, self.y = marker_tip
+        self.dx = abs(marker_tip[0] - self.x)
+        self.dy = abs(marker_tip[1] - self.y)
+        self.x, self.y = marker_tip
+        self.interval = timestamp - self._timestamp if not self._timestamp is None else 0.0
+        self._timestamp = timestamp
+        
+        # drop displacements older than time window
+        n = self._hist_t.shape[0]
+        while self._hist_size > 0 and (timestamp - self._hist_t[self._hist_head] >= self.window - 1e-9 or self._hist_size >= n):
+            self._sum_dx -= self._hist_dx[self._hist_head]
+            self._sum_dy -= self._hist_dy[self._hist_head]
+            self._hist_head = (self._hist_head + 1) % n
+            self._hist_size -= 1
+        
+        # append displacement
+        i = (self._hist_head + self._hist_size) % n
+        self._hist_t[i] = timestamp
+        self._hist_dx[i] = self.dx
+        self._hist_dy[i] = self.dy
+        self._hist_size += 1
+        self._sum_dx += self.dx
+        self._sum_dy += self.dy
+        
+        # velocity in pixels per second over time window
+        self.vx = self._sum_dx / self.window
+        self.vy = self._sum_dy / self.window
+        
+        # drop oldest trajectory point beyond limit
+        m = self._points.shape[0]
+        while self._point_size > max_points:
+            self._point_head = (self._point_head + 1) % m
+            self._point_size -= 1
+        
+        # append trajectory point on sufficient change
+        added = False
+        if self.dx > min_change or self.dy > min_change:
+            j = (self._point_head + self._point_size) % m
+            self._points[j] = marker_tip
+            self._point_size += 1
+            added = True
+        
+        return added
+    
+    # ~~~~~~~~ copy trajectory ~~~~~~~~
+    def copy(self):
+        other = Trajectory.__new__(Trajectory)
+        for name in Trajectory.__slots__:
+            value = getattr(self, name)
+            setattr(other, name, value.copy() if isinstance(value, numpy.ndarray) else value)
+        
+        return other
+
+
+# StrokeCanvas class
+class StrokeCanvas(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, thickness=4):
+        self._thickness = thickness
+        self._pad = thickness // 2 + 2
+        self._image = None
+        self._box = None
+        
+        return
+    
+    # ~~~~~~~~ clear canvas ~~~~~~~~
+    def reset(self):
+        # clear only the region covered by the stroke
+        if not self._box is None:
+            x0, y0, x1, y1 = self._box
+            self._image[y0:y1, x0:x1] = 0
+        self._box = None
+        
+        return
+    
+    # ~~~~~~~~ allocate canvas for frame size ~~~~~~~~
+    def allocate(self, shape):
+        if self._image is None or self._image.shape != shape:
+            self._image = numpy.zeros(shape, dtype='uint8')
+            self._box = None
+        
+        return
+    
+    # ~~~~~~~~ draw newest stroke segment ~~~~~~~~
+    def draw(self, p0, p1):
+        cv2.line(self._image, p0, p1, (255, 255, 255), self._thickness, cv2.LINE_AA)
+        
+        # grow bounding box of stroke
+        h, w = self._image.shape
+        x0 = max(0, min(p0[0], p1[0]) - self._pad)
+        y0 = max(0, min(p0[1], p1[1]) - self._pad)
+        x1 = min(w, max(p0[0], p1[0]) + self._pad + 1)
+        y1 = min(h, max(p0[1], p1[1]) + self._pad + 1)
+        if not self._box is None:
+            x0 = min(x0, self._box[0])
+            y0 = min(y0, self._box[1])
+            x1 = max(x1, self._box[2])
+            y1 = max(y1, self._box[3])
+        self._box = (x0, y0, x1, y1)
+        
+        return
+    
+    # ~~~~~~~~ redraw whole stroke ~~~~~~~~
+    def redraw(self, points):
+        self.reset()
+        for i in range(len(points)-1):
+            self.draw(points[i], points[i+1])
+        
+        return
+    
+    # ~~~~~~~~ bounding box of stroke ~~~~~~~~
+    def box(self):
+        return self._box
+    
+    # ~~~~~~~~ crop stroke at bounding box ~~~~~~~~
+    def crop(self):
+        if self._box is None:
+            return None
+        x0, y0, x1, y1 = self._box
+        
+        return self._image[y0:y1, x0:x1]
+
+
+# GlyphSegmenter class
+class GlyphSegmenter(object):
+    
+    # ~~~~~~~~ constructor ~~~~~~~~
+    def __init__(self, spike_ratio=2.0, min_jump=0.25, gap=0.15, reversal_angle=120.0, cues=('gap', 'reversal'),
+                 min_points=4, direction=1):
+        # a pen lift between glyphs is a fast move of the marker without a pen
+        # -- a run of steps faster than spike ratio times the median speed of the glyph is a candidate --
+        # -- the run must jump by min jump times the glyph height --
+        # -- cue 'gap' confirms runs ending beyond the glyph edge in writing direction by gap times its height --
+        # -- cue 'reversal' confirms runs turning away from the last glyph step by at least the given angle --
+        # -- direction is +1 if x grows in writing direction and -1 otherwise --
+        self.spike_ratio = spike_ratio
+        self.min_jump = min_jump
+        self.gap = gap
+        self.reversal_angle = reversal_angle
+        self.cues = tuple(cues)
+        self.min_points = min_points
+        self.direction = direction
+        self.reset()
+        
+        return
+    
+    # ~~~~~~~~ reset segmenter ~~~~~~~~
+    def reset(self):
+        self.glyphs = 0
+        self._origin = None
+        self._points = []
+        self._speeds = []
+        self._run = []
+        self._run_speeds = []
+        self._lifting = False
+        self._threshold = 0.0
+        self._timestamp = None
+        
+        return
+    
+    # ~~~~~~~~ number of points of current glyph ~~~~~~~~
+    def __len__(self):
+        return len(self._points)
+    
+    # ~~~~~~~~ check if fast run is a pen lift ~~~~~~~~
+    def _is_pen_lift(self):
+        points = numpy.array(self._points, dtype='float64')
+        end = numpy.array(self._run[-1], dtype='float64')
+        jump = end - points[-1]
+        height = max(points[:, 1].max() - points[:, 1].min(), points[:, 0].max() - points[:, 0].min(), 1.0)
+        if numpy.hypot(jump[0], jump[1]) < self.min_jump * height:
+            return False
+        
+        # run ends beyond the edge of glyph in writing direction
+        if 'gap' in self.cues:
+            edge = points[:, 0].max() if self.direction > 0 else points[:, 0].min()
+            if self.direction * (end[0] - edge) >= self.gap * height:
+                return True
+        
+        # run turns away from the last glyph step
+        if 'reversal' in self.cues:
+            step = points[-1] - points[-2]
+            norm = numpy.hypot(step[0], step[1]) * numpy.hypot(jump[0], jump[1])
+            if norm > 0:
+                angle = numpy.degrees(numpy.arccos(numpy.clip(numpy.dot(step, jump) / norm, -1.0, 1.0)))
+                if angle >= self.reversal_angle:
+                    return True
+        
+        return False
+    
+    # ~~~~~~~~ update with marker position ~~~~~~~~
+    def update(self, point, timestamp, min_change=0):
+        # first point of stroke
+        # -- position where the stroke starts is not a point as in Trajectory --
+        if len(self._points) == 0 and not self._lifting:
+            if self._origin is None:
+                self._origin = point
+            elif abs(point[0] - self._origin[0]) > min_change or abs(point[1] - self._origin[1]) > min_change:
+                self._points.append(point)
+                self._timestamp = timestamp
+            return None
+        
+        # point must move beyond minimum change from previous point
+        # -- change is not measured between frames as in Trajectory so slow writing keeps its points --
+        last = self._run[-1] if len(self._run) > 0 else self._points[-1]
+        if abs(point[0] - last[0]) <= min_change and abs(point[1] - last[1]) <= min_change:
+            return None
+        
+        # speed of step from previous point
+        interval = max(timestamp - self._timestamp, 1e-6)
+        speed = numpy.hypot(point[0] - last[0], point[1] - last[1]) / interval
+        self._timestamp = timestamp
+        
+        # fast steps are held back as a possible pen lift
+        # -- glyph completes as soon as the run is confirmed as pen lift --
+        # -- the rest of the pen lift is skipped and the next glyph starts at its first slow step --
+        # -- pen lift also ends when the marker slows down by spike ratio as the next glyph may start fast --
+        if self._lifting or len(self._points) >= self.min_points:
+            if not self._lifting:
+                self._threshold = self.spike_ratio * numpy.median(self._speeds)
+            slowed = self._lifting and self.spike_ratio * speed < max(self._run_speeds)
+            if speed >= self._threshold and not slowed:
+                self._run.append(point)
+                self._run_speeds.append(speed)
+                if self._lifting or not self._is_pen_lift():
+                    return None
+                glyph = self._points
+                self.glyphs += 1
+                self._points = []
+                self._speeds = []
+                self._lifting = True
+                return glyph
+        
+        # slow step after a pen lift starts next glyph and after another fast run continues glyph
+        if self._lifting:
+            self._points = [self._run[-1]]
+            self._lifting = False
+        elif len(self._run) > 0:
+            self._points += self._run
+            self._speeds += self._run_speeds
+        self._run = []
+        self._run_speeds = []
+        self._points.append(point)
+        self._speeds.append(speed)
+        
+        return None
+    
+    # ~~~~~~~~ complete last glyph at end of stroke ~~~~~~~~
+    def finish(self):
+        # a fast run at the end is the marker leaving and not part of the glyph
+        # -- nothing remains if the stroke ended during a pen lift --
+        glyph = self._points
+        self.reset()
+        
+        return glyph
+
+
+# ~~~~~~~~ check growing point limit of trajectories ~~~~~~~~
+def check_growth():
+    # empty trajectory
+    trajectory = Trajectory(max_points=50)
+    trajectory.update((10, 10), 0.0, 10, 100)
+    assert len(trajectory) == 0
+    
+    # partly filled trajectory wrapped around its ring buffer
+    trajectory = Trajectory(max_points=4)
+    expected = []
+    for i in range(7):
+        point = (20 * (i + 1), 10)
+        trajectory.update(point, 0.1 * i, 10, 4)
+        expected = (expected + [point])[-5:]
+    assert trajectory.points() == expected[-len(trajectory):], trajectory.points()
+    before = trajectory.points()
+    for i in range(7, 12):
+        point = (20 * (i + 1), 10)
+        trajectory.update(point, 0.1 * i, 10, 8)
+        before.append(point)
+    assert trajectory.points() == before[-len(trajectory):] and len(trajectory) <= 9, trajectory.points()
+    assert trajectory.last() == before[-1]
+    
+    return
+
+
+# main
+if __name__ == '__main__':
+    check_growth()
+    print('[INFO] Trajectory checks passed')